@@ -0,0 +1,145 @@
+"""Incremental per-hour rollups of server.log for activity queries.
+
+Each run reads only the log bytes added since the last run and adds them to
+an SQLite table keyed by (hour, ip, space, action), where ``action`` is the
+first word of the logged message ("uploaded", "downloaded", "view", ...).
+Lines of the ``ACTION_LOGGER`` logger are indexed, as are untagged lines
+from logs written before the logger name was part of the format. Access
+lines, startup banners and other messages in the same file are skipped.
+"""
+import collections
+import os
+import re
+import sqlite3
+import threading
+
+ACTION_LOGGER = 'action'
+LOG_FORMAT = '%(asctime)s [%(name)s] %(message)s'
+# The tag is optional for older lines; an IP (or "worker", ...) never contains "[" or escape codes
+LINE_RE = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}):\d{2}:\d{2},\d{3} (?:\[' + ACTION_LOGGER + r'\] )?'
+                     r'([\w.:%-]+) (\S+)(.*)$')
+SPACE_RE = re.compile(r' (?:for|space) (\S+)$')
+BYTES_RE = re.compile(r'\((\d+) bytes\)')
+READ_SIZE = 4 * 1024 * 1024
+GROUP_COLUMNS = {
+    'hour': 'hour',
+    'day': 'substr(hour, 1, 10)',
+    'ip': 'ip',
+    'space': 'space',
+    'action': 'action',
+}
+
+
+def parse_line(line):
+    """Return (hour, ip, space, action, bytes) for an action log line, or None."""
+    m = LINE_RE.match(line)
+    if not m:
+        return None
+    hour, ip, action, rest = m.groups()
+    if action == '-':
+        # Untagged werkzeug access line: '<ip> - - [date] "GET ..." 200 -'
+        return None
+    space = SPACE_RE.search(rest)
+    size = BYTES_RE.search(rest)
+    return hour, ip, space.group(1) if space else '', action, int(size.group(1)) if size else 0
+
+
+class ActivityIndex:
+    """Rollup database built incrementally from a log file."""
+
+    def __init__(self, log_file, db_file):
+        self.log_file = log_file
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS rollup ('
+                         'hour TEXT, ip TEXT, space TEXT, action TEXT, '
+                         'count INTEGER, bytes INTEGER, '
+                         'PRIMARY KEY (hour, ip, space, action))')
+            conn.execute('CREATE TABLE IF NOT EXISTS state (inode INTEGER, offset INTEGER)')
+
+    def _connect(self):
+        return sqlite3.connect(self.db_file, timeout=30)
+
+    def _flush(self, conn, counts, inode, offset):
+        conn.executemany(
+            'INSERT INTO rollup VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (hour, ip, space, action) DO UPDATE SET '
+            'count = count + excluded.count, bytes = bytes + excluded.bytes',
+            [key + tuple(value) for key, value in counts.items()])
+        conn.execute('DELETE FROM state')
+        conn.execute('INSERT INTO state VALUES (?, ?)', (inode, offset))
+        conn.commit()
+        counts.clear()
+
+    def update(self, blocking=True):
+        """Index log lines written since the last call. Returns the number of lines read.
+
+        With ``blocking=False``, returns 0 right away if another update is running.
+        """
+        if not self.lock.acquire(blocking):
+            return 0
+        try:
+            return self._update()
+        finally:
+            self.lock.release()
+
+    def _update(self):
+        with self._connect() as conn:
+            try:
+                st = os.stat(self.log_file)
+            except FileNotFoundError:
+                return 0
+            row = conn.execute('SELECT inode, offset FROM state').fetchone()
+            inode, offset = row if row else (None, 0)
+            # A new or truncated file means the log was rotated: start over on it
+            if inode != st.st_ino or st.st_size < offset:
+                offset = 0
+            if st.st_size == offset:
+                return 0
+
+            lines = 0
+            counts = collections.defaultdict(lambda: [0, 0])
+            with open(self.log_file, 'rb') as f:
+                f.seek(offset)
+                while True:
+                    data = f.read(READ_SIZE)
+                    end = data.rfind(b'\n')
+                    if end < 0:
+                        break
+                    for raw in data[:end].split(b'\n'):
+                        parsed = parse_line(raw.decode('utf-8', 'replace').rstrip('\r'))
+                        lines += 1
+                        if parsed is None:
+                            continue
+                        entry = counts[parsed[:4]]
+                        entry[0] += 1
+                        entry[1] += parsed[4]
+                    # Only whole lines are consumed; a partial last line is read again next time
+                    offset += end + 1
+                    f.seek(offset)
+                    self._flush(conn, counts, st.st_ino, offset)
+            return lines
+
+    def query(self, start, end, group_by=('ip',), filters=None, order='count', limit=100):
+        """Aggregate counts and bytes for hours in [start, end).
+
+        ``start`` and ``end`` are 'YYYY-MM-DD HH' strings (shorter prefixes work).
+        """
+        columns = [c for c in group_by if c in GROUP_COLUMNS]
+        select = [f'{GROUP_COLUMNS[c]} AS {c}' for c in columns]
+        where = ['hour >= ?', 'hour < ?']
+        params = [start, end]
+        for column, value in (filters or {}).items():
+            if column in ('ip', 'space', 'action') and value:
+                where.append(f'{column} = ?')
+                params.append(value)
+        sql = (f"SELECT {', '.join(select + ['SUM(count) AS count', 'SUM(bytes) AS bytes'])} "
+               f"FROM rollup WHERE {' AND '.join(where)}")
+        if columns:
+            sql += f" GROUP BY {', '.join(columns)}"
+        sql += f" ORDER BY {'bytes' if order == 'bytes' else 'count'} DESC LIMIT ?"
+        params.append(limit)
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            return [dict(row) for row in conn.execute(sql, params) if row['count']]
@@ -0,0 +1,112 @@
+"""Streaming tar export and import of whole spaces.
+
+Exports are generated block by block, so memory use does not depend on file
+sizes; zstd compression (optional, ``pip install zstandard``) can use several
+threads. Imports accept plain, gzip, bzip2, xz or zstd tars.
+"""
+import os
+import tarfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+READ_SIZE = 1024 * 1024
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+ZSTD_AVAILABLE = zstandard is not None
+ARCHIVE_ERRORS = (tarfile.TarError, EOFError) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+class ArchiveChanged(Exception):
+    """A file changed size while it was being written to the tar."""
+
+
+def local_member(path):
+    """Open a file for ``iter_tar``: returns (size, mtime, chunks), or None if it is gone.
+
+    The size comes from the open file, so a concurrent replace cannot make
+    the header and the data disagree.
+    """
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    st = os.fstat(f.fileno())
+
+    def chunks():
+        with f:
+            for chunk in iter(lambda: f.read(READ_SIZE), b''):
+                yield chunk
+    return st.st_size, st.st_mtime, chunks()
+
+
+def iter_tar(members):
+    """Yield a tar stream for ``(arcname, open_member)`` pairs.
+
+    ``open_member`` is called when the member is reached and returns
+    (size, mtime, chunks) like ``local_member``, or None to skip it.
+    """
+    for arcname, open_member in members:
+        opened = open_member()
+        if opened is None:
+            continue
+        size, mtime, chunks = opened
+        info = tarfile.TarInfo(arcname)
+        info.size = size
+        info.mtime = int(mtime)
+        info.mode = 0o644
+        yield info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        written = 0
+        for chunk in chunks:
+            written += len(chunk)
+            yield chunk
+        if written != size:
+            raise ArchiveChanged(arcname)
+        if size % BLOCK_SIZE:
+            yield b'\0' * (BLOCK_SIZE - size % BLOCK_SIZE)
+    # End-of-archive marker, padded to a full record like tarfile does
+    yield b'\0' * tarfile.RECORDSIZE
+
+
+def compress_zstd(chunks, level=3, threads=0):
+    """Compress a stream of chunks with zstd; ``threads`` > 0 compresses in parallel."""
+    compressor = zstandard.ZstdCompressor(level=level, threads=threads).compressobj()
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+class _PrefixedReader:
+    """Give back bytes already read from a stream before reading on."""
+
+    def __init__(self, prefix, stream):
+        self._prefix = prefix
+        self._stream = stream
+
+    def read(self, size=-1):
+        if not self._prefix:
+            return self._stream.read(size)
+        if size is None or size < 0:
+            data, self._prefix = self._prefix + self._stream.read(), b''
+            return data
+        data, self._prefix = self._prefix[:size], self._prefix[size:]
+        return data
+
+
+def open_archive(stream):
+    """Return a readable tar stream for ``tarfile`` mode 'r|*', unwrapping zstd."""
+    magic = b''
+    while len(magic) < len(ZSTD_MAGIC):
+        chunk = stream.read(len(ZSTD_MAGIC) - len(magic))
+        if not chunk:
+            break
+        magic += chunk
+    if magic == ZSTD_MAGIC:
+        if zstandard is None:
+            raise tarfile.CompressionError('zstd archives need the zstandard package')
+        return zstandard.ZstdDecompressor().stream_reader(_PrefixedReader(magic, stream), read_across_frames=True)
+    return _PrefixedReader(magic, stream)
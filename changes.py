@@ -0,0 +1,83 @@
+"""Change sequence numbers for manifests and incremental mirroring.
+
+Every write or delete of a file gets the next sequence number. Numbers are
+shared by all spaces, so they increase within a space but are not
+contiguous. Only the latest change of each file is kept; a deleted file
+stays as a "delete" row so mirrors can see it went away.
+
+Each space also has an epoch, a random id that changes whenever its
+sequence numbers start over (for example when the space moves to another
+cluster node). A client that sees a new epoch must re-read the manifest.
+"""
+import sqlite3
+import time
+import uuid
+
+
+class ChangeLog:
+    def __init__(self, db_file):
+        self.db_file = db_file
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS changes ('
+                         'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'space TEXT, filename TEXT, op TEXT, time REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS changes_file ON changes (space, filename)')
+            conn.execute('CREATE INDEX IF NOT EXISTS changes_space ON changes (space, seq)')
+            conn.execute('CREATE TABLE IF NOT EXISTS epochs (space TEXT PRIMARY KEY, epoch TEXT)')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def record(self, space, filename, op='put'):
+        """Record that a file was written ("put") or removed ("delete"). Returns its sequence."""
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            seq = conn.execute('INSERT INTO changes (space, filename, op, time) VALUES (?, ?, ?, ?)',
+                               (space, filename, op, time.time())).lastrowid
+            conn.execute('DELETE FROM changes WHERE space = ? AND filename = ? AND seq < ?',
+                         (space, filename, seq))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        return seq
+
+    def epoch(self, space):
+        """The current epoch of a space, created on first use."""
+        with self._connect() as conn:
+            conn.execute('INSERT OR IGNORE INTO epochs VALUES (?, ?)', (space, uuid.uuid4().hex))
+            return conn.execute('SELECT epoch FROM epochs WHERE space = ?', (space,)).fetchone()[0]
+
+    def reset(self, space):
+        """Forget the changes of a space and start a new epoch for it."""
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM changes WHERE space = ?', (space,))
+            conn.execute('INSERT OR REPLACE INTO epochs VALUES (?, ?)', (space, uuid.uuid4().hex))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def latest(self, space):
+        """The highest sequence of a space, 0 if nothing was recorded."""
+        with self._connect() as conn:
+            row = conn.execute('SELECT MAX(seq) FROM changes WHERE space = ?', (space,)).fetchone()
+        return row[0] or 0
+
+    def sequences(self, space):
+        """Return {filename: seq} of the files currently present in a space."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT filename, seq FROM changes WHERE space = ? AND op = 'put'",
+                                (space,)).fetchall()
+        return {row['filename']: row['seq'] for row in rows}
+
+    def since(self, space, seq, limit=1000):
+        """Changes of a space after ``seq``, oldest first."""
+        with self._connect() as conn:
+            rows = conn.execute('SELECT seq, filename, op, time FROM changes '
+                                'WHERE space = ? AND seq > ? ORDER BY seq LIMIT ?',
+                                (space, seq, limit)).fetchall()
+        return [dict(row) for row in rows]
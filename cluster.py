@@ -0,0 +1,94 @@
+"""Cluster helpers: consistent hashing of spaces to nodes and space transfer.
+
+Run ``python cluster.py rebalance`` after changing ``FTP_CLUSTER_NODES`` on
+every node to move each space to its new owner.
+"""
+import bisect
+import hashlib
+import json
+import os
+import sys
+import tarfile
+import urllib.request
+
+REPLICAS = 100
+FORWARD_HEADER = 'X-FTP-Forwarded'
+SECRET_HEADER = 'X-FTP-Cluster-Secret'
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """Consistent hash ring with virtual nodes over a static member list."""
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        self.nodes = list(nodes)
+        ring = sorted((_hash(f'{node}#{i}'), node) for node in self.nodes for i in range(replicas))
+        self._keys = [h for h, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    def node_for(self, space):
+        """Return the member that owns a space."""
+        i = bisect.bisect(self._keys, _hash(space)) % len(self._keys)
+        return self._nodes[i]
+
+
+def pack_space(upload_folder, fileobj):
+    """Write a whole space folder, including .meta and .versions, as a tar stream."""
+    with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+        for name in sorted(os.listdir(upload_folder)):
+            tar.add(os.path.join(upload_folder, name), arcname=name)
+
+
+def unpack_space(fileobj, upload_folder):
+    """Extract a tar stream into a space folder, skipping anything unsafe.
+
+    Returns the number of regular files written.
+    """
+    count = 0
+    root = os.path.realpath(upload_folder)
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+        for member in tar:
+            target = os.path.realpath(os.path.join(root, member.name))
+            if os.path.isabs(member.name) or not target.startswith(root + os.sep):
+                continue
+            if member.isdir():
+                os.makedirs(target, exist_ok=True)
+            elif member.isfile():
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                src = tar.extractfile(member)
+                with open(target, 'wb') as dst:
+                    while True:
+                        chunk = src.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                os.utime(target, (member.mtime, member.mtime))
+                count += 1
+    return count
+
+
+def rebalance(nodes, secret=None):
+    """Ask every member to push the spaces it no longer owns to their owners."""
+    results = {}
+    for node in nodes:
+        req = urllib.request.Request(node.rstrip('/') + '/cluster/rebalance', data=b'', method='POST')
+        if secret:
+            req.add_header(SECRET_HEADER, secret)
+        try:
+            with urllib.request.urlopen(req) as resp:
+                results[node] = json.load(resp)
+        except OSError as e:
+            results[node] = {'error': str(e)}
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] != 'rebalance':
+        sys.exit('usage: python cluster.py rebalance')
+    members = [n.strip() for n in os.environ.get('FTP_CLUSTER_NODES', '').split(',') if n.strip()]
+    if not members:
+        sys.exit('FTP_CLUSTER_NODES is not set')
+    print(json.dumps(rebalance(members, os.environ.get('FTP_CLUSTER_SECRET')), indent=4, ensure_ascii=False))
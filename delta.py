@@ -0,0 +1,251 @@
+"""rsync-style block delta for re-uploading modified large files.
+
+The server publishes block signatures of its copy (Adler-32 weak checksum,
+which can be rolled one byte at a time, plus a BLAKE2b strong hash). The
+client scans its file for blocks the server already has and sends only the
+rest as literal data.
+
+Delta stream format::
+
+    b'FTPDELTA' | block_size:u32 | sha256 of the new file:32 bytes
+    b'C' | first_block:u64 | block_count:u32      copy blocks from the basis
+    b'L' | length:u32 | data                      literal bytes
+    b'E'                                          end
+
+Usage: python delta.py push http://host:5000/<space>/ <file> [remote name]
+"""
+import hashlib
+import http.client
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+
+MAGIC = b'FTPDELTA'
+ADLER_MOD = 65521
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 1024 * 1024
+MAX_LITERAL = 1024 * 1024
+# Bytes to roll past the last match before only probing block-aligned offsets
+MAX_ROLL = 256 * 1024
+COPY_BUFFER = 1024 * 1024
+
+
+class DeltaError(ValueError):
+    pass
+
+
+def choose_block_size(size):
+    """About sqrt(size), rounded to 1 KiB: few blocks for big files, fine grain for small ones."""
+    block_size = int(math.sqrt(size)) // 1024 * 1024
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+
+def strong_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def file_signature(path, block_size=None):
+    """Return {'size', 'block_size', 'blocks': [[weak, strong], ...]} for a file."""
+    size = os.path.getsize(path)
+    block_size = block_size or choose_block_size(size)
+    blocks = []
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            blocks.append([zlib.adler32(block), strong_hash(block)])
+    return {'size': size, 'block_size': block_size, 'blocks': blocks}
+
+
+def _emit_literal(out, data):
+    for i in range(0, len(data), MAX_LITERAL):
+        piece = data[i:i + MAX_LITERAL]
+        out.write(b'L' + struct.pack('>I', len(piece)))
+        out.write(piece)
+
+
+def make_delta(path, signature, out):
+    """Write the delta turning the signed basis into ``path``. Returns literal byte count."""
+    block_size = signature['block_size']
+    table = {}
+    for index, (weak, strong) in enumerate(signature['blocks']):
+        table.setdefault(weak, {}).setdefault(strong, index)
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(COPY_BUFFER), b''):
+            digest.update(chunk)
+    out.write(MAGIC + struct.pack('>I', block_size) + digest.digest())
+
+    size = os.path.getsize(path)
+    literal_bytes = 0
+    run = None  # pending [first_block, count] copy run
+    if not table:
+        # Nothing to match against: send the file as it is
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(COPY_BUFFER), b''):
+                _emit_literal(out, chunk)
+                literal_bytes += len(chunk)
+        out.write(b'E')
+        return literal_bytes
+    if size == 0:
+        out.write(b'E')
+        return 0
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+
+        def flush_run():
+            nonlocal run
+            if run is not None:
+                out.write(b'C' + struct.pack('>QI', run[0], run[1]))
+                run = None
+
+        pos = literal_start = 0
+        weak = None
+        while pos < size:
+            end = min(pos + block_size, size)
+            if weak is None:
+                weak = zlib.adler32(data[pos:end])
+                a, b = weak & 0xffff, weak >> 16
+            candidates = table.get(weak)
+            if candidates:
+                index = candidates.get(strong_hash(data[pos:end]))
+                if index is not None:
+                    if literal_start < pos:
+                        flush_run()
+                        _emit_literal(out, data[literal_start:pos])
+                        literal_bytes += pos - literal_start
+                    if run is not None and run[0] + run[1] == index:
+                        run[1] += 1
+                    else:
+                        flush_run()
+                        run = [index, 1]
+                    pos = literal_start = end
+                    weak = None
+                    continue
+            if end - pos < block_size or end == size:
+                # The final short window only matches the basis' final block; stop rolling
+                break
+            if pos - literal_start >= MAX_ROLL:
+                # Rolling is slow in Python: after a long miss, only try the next window
+                pos = end
+                weak = None
+                continue
+            # Roll the window one byte forward
+            out_byte, in_byte = data[pos], data[end]
+            a = (a - out_byte + in_byte) % ADLER_MOD
+            b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+            weak = (b << 16) | a
+            pos += 1
+        if literal_start < size:
+            flush_run()
+            _emit_literal(out, data[literal_start:size])
+            literal_bytes += size - literal_start
+        flush_run()
+    out.write(b'E')
+    return literal_bytes
+
+
+def _read_exact(stream, n):
+    data = b''
+    while len(data) < n:
+        chunk = stream.read(n - len(data))
+        if not chunk:
+            raise DeltaError('Truncated delta')
+        data += chunk
+    return data
+
+
+def apply_delta(basis_path, stream, out):
+    """Rebuild a file from a basis and a delta stream, checking the final SHA-256.
+
+    Returns (literal_bytes, copied_bytes).
+    """
+    header = _read_exact(stream, len(MAGIC) + 4 + 32)
+    if header[:len(MAGIC)] != MAGIC:
+        raise DeltaError('Not a delta stream')
+    block_size = struct.unpack('>I', header[len(MAGIC):len(MAGIC) + 4])[0]
+    expected = header[len(MAGIC) + 4:]
+    digest = hashlib.sha256()
+    literal_bytes = copied_bytes = 0
+    basis = open(basis_path, 'rb') if basis_path else None
+    basis_size = os.path.getsize(basis_path) if basis_path else 0
+    try:
+        while True:
+            op = _read_exact(stream, 1)
+            if op == b'E':
+                break
+            if op == b'L':
+                remaining = struct.unpack('>I', _read_exact(stream, 4))[0]
+                literal_bytes += remaining
+                while remaining:
+                    chunk = _read_exact(stream, min(remaining, COPY_BUFFER))
+                    digest.update(chunk)
+                    out.write(chunk)
+                    remaining -= len(chunk)
+            elif op == b'C':
+                first, count = struct.unpack('>QI', _read_exact(stream, 12))
+                start = first * block_size
+                if basis is None or start >= basis_size:
+                    raise DeltaError('Copy outside the basis file')
+                remaining = min(count * block_size, basis_size - start)
+                copied_bytes += remaining
+                basis.seek(start)
+                while remaining:
+                    chunk = basis.read(min(remaining, COPY_BUFFER))
+                    digest.update(chunk)
+                    out.write(chunk)
+                    remaining -= len(chunk)
+            else:
+                raise DeltaError('Unknown delta instruction')
+    finally:
+        if basis is not None:
+            basis.close()
+    if digest.digest() != expected:
+        raise DeltaError('Checksum mismatch after rebuilding the file')
+    return literal_bytes, copied_bytes
+
+
+def push(space_url, path, remote_name=None):
+    """Upload ``path`` to a space, sending only blocks the server does not have."""
+    remote_name = remote_name or os.path.basename(path)
+    base = space_url.rstrip('/') + '/'
+    quoted = urllib.parse.quote(remote_name)
+    try:
+        with urllib.request.urlopen(base + 'signature/' + quoted) as resp:
+            signature = json.load(resp)
+    except urllib.error.HTTPError as e:
+        if e.code != 404:
+            raise
+        # Nothing to diff against: the delta is one big literal
+        signature = {'basis': '', 'block_size': choose_block_size(os.path.getsize(path)), 'blocks': []}
+
+    with tempfile.TemporaryFile() as delta:
+        make_delta(path, signature, delta)
+        length = delta.tell()
+        delta.seek(0)
+        parsed = urllib.parse.urlsplit(base)
+        conn_class = http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
+        conn = conn_class(parsed.netloc)
+        try:
+            query = urllib.parse.urlencode({'basis': signature['basis']})
+            conn.request('POST', f'{parsed.path}delta/{quoted}?{query}', body=delta,
+                         headers={'Content-Type': 'application/octet-stream', 'Content-Length': str(length)})
+            resp = conn.getresponse()
+            body = resp.read()
+        finally:
+            conn.close()
+    if resp.status != 200:
+        raise RuntimeError(f'Delta upload failed ({resp.status}): {body.decode("utf-8", "replace")}')
+    return json.loads(body)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (4, 5) or sys.argv[1] != 'push':
+        sys.exit('usage: python delta.py push http://host:5000/<space>/ <file> [remote name]')
+    print(json.dumps(push(*sys.argv[2:]), indent=4))
@@ -1,4 +1,4 @@
-from flask import Flask, request, send_from_directory, render_template_string, send_file
+from flask import Flask, request, send_from_directory, render_template_string, send_file, jsonify, Response, redirect, g
 import os
 import datetime
 import json
@@ -7,6 +7,31 @@ import shutil
 import zipfile
 import io
 import logging
+import mimetypes
+import threading
+import time
+import hmac
+import http.client
+import socket
+import tempfile
+import urllib.parse
+import urllib.request
+import hashlib
+import shlex
+import contextlib
+import subprocess
+import email.utils
+import fcntl
+from xml.sax.saxutils import escape as xml_escape
+from storage import LocalStorage, S3Storage
+from cluster import HashRing, pack_space, unpack_space, FORWARD_HEADER, SECRET_HEADER
+from throttle import Shaper, ThrottledReader, TransferBody
+from activity import ActivityIndex, ACTION_LOGGER, GROUP_COLUMNS, LOG_FORMAT
+from profiling import Profiler, phase
+from jobs import JobQueue, start_workers, worker_loop
+from changes import ChangeLog
+from backup import iter_tar, local_member, compress_zstd, open_archive, ARCHIVE_ERRORS, ZSTD_AVAILABLE
+from delta import file_signature, apply_delta, DeltaError, MIN_BLOCK_SIZE, MAX_BLOCK_SIZE
 
 app = Flask(__name__)
 BASE_UPLOAD_FOLDER = 'uploads'
@@ -18,11 +43,95 @@ META_FILE_NAME = 'metadata.json'
 COMMENTS_FILE_NAME = 'comments.json'
 META_FOLDER_NAME = '.meta'
 VERSIONS_FOLDER_NAME = '.versions'
+SIGNATURES_FOLDER_NAME = 'signatures'
 LOG_FILE = 'server.log'
+ACTIVITY_DB = 'activity.db'
+PROFILE_FOLDER = 'profiles'
+JOBS_DB = 'jobs.db'
+CHANGES_DB = 'changes.db'
+# Optional S3-compatible object tier for old versions and cold files
+OBJECT_STORE_BUCKET = os.environ.get('FTP_S3_BUCKET')
+OBJECT_STORE_ENDPOINT = os.environ.get('FTP_S3_ENDPOINT')
+VERSION_TIER_AGE = float(os.environ.get('FTP_VERSION_TIER_DAYS', '1')) * 86400
+COLD_FILE_AGE = float(os.environ.get('FTP_COLD_FILE_DAYS', '30')) * 86400
+TIER_INTERVAL = 3600
+
+local_storage = LocalStorage(BASE_UPLOAD_FOLDER)
+object_storage = S3Storage(OBJECT_STORE_BUCKET, OBJECT_STORE_ENDPOINT) if OBJECT_STORE_BUCKET else None
+
+# Optional cluster mode: spaces are spread over these nodes by consistent hashing
+CLUSTER_NODES = [n.strip().rstrip('/') for n in os.environ.get('FTP_CLUSTER_NODES', '').split(',') if n.strip()]
+NODE_URL = os.environ.get('FTP_NODE_URL', '').rstrip('/')
+CLUSTER_REDIRECT = os.environ.get('FTP_CLUSTER_MODE', 'proxy') == 'redirect'
+CLUSTER_SECRET = os.environ.get('FTP_CLUSTER_SECRET')
+# First path segments that are served by whichever node receives them
+CLUSTER_LOCAL_PREFIXES = {'static', 'cluster', 'admin'}
+PROXY_TIMEOUT = 60
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                      'te', 'trailers', 'transfer-encoding', 'upgrade', 'host'}
+
+# Bandwidth shaping; 0 disables a limit. Rates are per second.
+shaper = Shaper(
+    ip_bytes=int(os.environ.get('FTP_IP_BYTES_PER_SEC', '0')),
+    space_bytes=int(os.environ.get('FTP_SPACE_BYTES_PER_SEC', '0')),
+    total_bytes=int(os.environ.get('FTP_TOTAL_BYTES_PER_SEC', '0')),
+    ip_requests=float(os.environ.get('FTP_IP_REQUESTS_PER_SEC', '0')),
+    space_requests=float(os.environ.get('FTP_SPACE_REQUESTS_PER_SEC', '0')),
+    max_transfers=int(os.environ.get('FTP_MAX_TRANSFERS_PER_IP', '0')),
+)
+# Endpoints whose bodies count against byte limits and transfer slots
+TRANSFER_ENDPOINTS = {'upload_file', 'upload_folder', 'download_file', 'download_batch', 'signature', 'delta_upload', 'webdav',
+                      'export_space', 'import_space'}
+
+activity_index = ActivityIndex(LOG_FILE, ACTIVITY_DB)
+# Catch up on the existing log in the background; requests only add what is new
+threading.Thread(target=activity_index.update, daemon=True).start()
+
+# Post-upload processing runs in worker processes fed from jobs.db
+job_queue = JobQueue(JOBS_DB)
+JOB_WORKERS = int(os.environ.get('FTP_JOB_WORKERS', '2'))
+# Set when ftp.py is run directly and starts worker processes. Under
+# ``flask run`` or a WSGI server a worker thread is started on first use.
+job_workers_started = False
+job_thread = None
+job_thread_lock = threading.Lock()
+# Optional virus scanner; the file path is appended. Exit 0 = clean, 1 = infected
+SCAN_COMMAND = os.environ.get('FTP_SCAN_COMMAND')
+
+# Change sequence per file, for /<space>/manifest and /<space>/changes
+change_log = ChangeLog(CHANGES_DB)
+
+# zstd settings for /<space>/export?compress=zstd
+EXPORT_ZSTD_LEVEL = int(os.environ.get('FTP_EXPORT_ZSTD_LEVEL', '3'))
+EXPORT_ZSTD_THREADS = int(os.environ.get('FTP_EXPORT_ZSTD_THREADS', str(os.cpu_count() or 1)))
+
+# Request profiling: send the X-FTP-Profile header (equal to FTP_PROFILE_TOKEN;
+# ignored when no token is set) for a cProfile capture, or enable sampling /
+# slow-request capture
+PROFILE_HEADER = 'X-FTP-Profile'
+PROFILE_TOKEN = os.environ.get('FTP_PROFILE_TOKEN')
+profiler = Profiler(
+    PROFILE_FOLDER,
+    keep=int(os.environ.get('FTP_PROFILE_KEEP', '50')),
+    sample_rate=float(os.environ.get('FTP_PROFILE_SAMPLE_RATE', '0')),
+    slow_ms=float(os.environ.get('FTP_SLOW_REQUEST_MS', '0')),
+)
+
+hash_ring = None
+cluster_addrs = set()
+if CLUSTER_NODES:
+    if NODE_URL not in CLUSTER_NODES:
+        raise RuntimeError('FTP_NODE_URL must be one of FTP_CLUSTER_NODES')
+    hash_ring = HashRing(CLUSTER_NODES)
+    for node in CLUSTER_NODES:
+        try:
+            cluster_addrs.add(socket.gethostbyname(urllib.parse.urlsplit(node).hostname))
+        except OSError:
+            pass
 
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s %(message)s',
+    format=LOG_FORMAT,
     filename=LOG_FILE,
     encoding='utf-8'
 )
@@ -52,29 +161,474 @@ app.jinja_env.globals.update(get_text_color=get_text_color)
 
 def log_action(ip, action):
     """Record an action performed by an IP."""
-    logging.info(f"{ip} {action}")
+    logging.getLogger(ACTION_LOGGER).info(f"{ip} {action}")
+
+def storage_key(*parts):
+    return '/'.join(parts)
+
+def find_storage(key):
+    """Return the tier holding a key, checking local disk first."""
+    if local_storage.exists(key):
+        return local_storage
+    if object_storage is not None and object_storage.exists(key):
+        return object_storage
+    return None
 
 def archive_file(upload_folder, filename):
-    """Save current version of a file before overwriting or deleting."""
-    src = os.path.join(upload_folder, filename)
-    if not os.path.exists(src):
+    """Save current version of a file before overwriting or deleting.
+
+    Version names carry microseconds and never replace an existing version,
+    even when several archives of one file happen at the same moment.
+    """
+    space = os.path.basename(upload_folder)
+    key = storage_key(space, filename)
+    storage = find_storage(key)
+    if storage is None:
         return
-    versions_dir = os.path.join(upload_folder, VERSIONS_FOLDER_NAME, filename)
-    os.makedirs(versions_dir, exist_ok=True)
-    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-    shutil.move(src, os.path.join(versions_dir, f'{timestamp}_{filename}'))
+    moment = datetime.datetime.now()
+    while True:
+        version_key = storage_key(space, VERSIONS_FOLDER_NAME, filename,
+                                  f"{moment.strftime('%Y%m%d_%H%M%S_%f')}_{filename}")
+        if find_storage(version_key) is None:
+            break
+        moment += datetime.timedelta(microseconds=1)
+    storage.move(key, version_key)
+
+def stage_version(upload_folder, filename, version):
+    """Move a stored version to a local staging path, fetching it from the object tier if needed.
+
+    Staging first means archiving the current file cannot clobber the version
+    being restored when both get the same timestamp.
+    """
+    space = os.path.basename(upload_folder)
+    key = storage_key(space, VERSIONS_FOLDER_NAME, filename, version)
+    staged_path = os.path.join(upload_folder, VERSIONS_FOLDER_NAME, f'.restoring_{filename}')
+    os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+    if local_storage.exists(key):
+        os.replace(local_storage.path(key), staged_path)
+    elif object_storage is not None and object_storage.exists(key):
+        object_storage.download(key, staged_path)
+        object_storage.delete(key)
+    else:
+        return None
+    return staged_path
+
+def move_versions(src_space, dst_space, filename):
+    """Move the version history of a file to another space, in every tier."""
+    src_prefix = storage_key(src_space, VERSIONS_FOLDER_NAME, filename) + '/'
+    for tier in (local_storage, object_storage):
+        if tier is None:
+            continue
+        for key in tier.list(src_prefix):
+            tier.move(key, storage_key(dst_space, VERSIONS_FOLDER_NAME, filename, key.rsplit('/', 1)[1]))
+    local_storage.delete_prefix(src_prefix)
+
+def send_from_object_storage(key, filename):
+    """Stream an object to the client, honouring a single Range header with a ranged GET."""
+    size = object_storage.size(key)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    byte_range = request.range.range_for_length(size) if request.range else None
+    if byte_range:
+        start, stop = byte_range
+        resp = Response(object_storage.open(key, start, stop - 1), 206, mimetype=mimetype)
+        resp.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        resp.headers['Content-Length'] = str(stop - start)
+    else:
+        resp = Response(object_storage.open(key), mimetype=mimetype)
+        resp.headers['Content-Length'] = str(size)
+    resp.headers['Accept-Ranges'] = 'bytes'
+    return resp
+
+def is_unchanged(path, st):
+    """True if ``path`` is still the file ``st`` was taken from, with the same content."""
+    try:
+        current = os.stat(path)
+    except FileNotFoundError:
+        return False
+    return (current.st_ino, current.st_size, current.st_mtime_ns) == (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def apply_tiering():
+    """Move old versions and cold files from local disk to the object tier."""
+    if object_storage is None:
+        return
+    now = time.time()
+    for space in os.listdir(BASE_UPLOAD_FOLDER):
+        upload_folder = os.path.join(BASE_UPLOAD_FOLDER, space)
+        if not os.path.isdir(upload_folder):
+            continue
+        for key in local_storage.list(storage_key(space, VERSIONS_FOLDER_NAME) + '/'):
+            if key.rsplit('/', 1)[1].startswith('.restoring_'):
+                continue
+            if now - local_storage.getmtime(key) > VERSION_TIER_AGE:
+                st = os.stat(local_storage.path(key))
+                object_storage.copy_in(local_storage.path(key), key)
+                if is_unchanged(local_storage.path(key), st):
+                    os.remove(local_storage.path(key))
+                else:
+                    # Restored while it was being copied
+                    object_storage.delete(key)
+
+        tiered = []
+        for filename, meta in load_metadata(upload_folder).items():
+            file_path = os.path.join(upload_folder, filename)
+            if meta.get('tier') == 'object' or not os.path.isfile(file_path):
+                continue
+            st = os.stat(file_path)
+            if now - max(st.st_atime, st.st_mtime) <= COLD_FILE_AGE:
+                continue
+            key = storage_key(space, filename)
+            # Copy first and drop the local file only if nobody replaced it meanwhile
+            object_storage.copy_in(file_path, key)
+            with metadata_lock(upload_folder):
+                metadata = load_metadata(upload_folder)
+                if filename in metadata and is_unchanged(file_path, st):
+                    os.remove(file_path)
+                    metadata[filename]['tier'] = 'object'
+                    save_metadata(upload_folder, metadata)
+                    tiered.append(filename)
+                else:
+                    object_storage.delete(key)
+        if tiered:
+            log_action('tiering', f"moved {tiered} to object storage for {space}")
+
+def tiering_loop():
+    while True:
+        try:
+            apply_tiering()
+        except Exception:
+            logging.exception('tiering failed')
+        time.sleep(TIER_INTERVAL)
+
+def merge_metadata(space, updates):
+    """Set entries of a space's metadata, removing those given as None, under its lock."""
+    upload_folder = os.path.join(BASE_UPLOAD_FOLDER, space)
+    with metadata_lock(upload_folder):
+        metadata = load_metadata(upload_folder)
+        for filename, entry in updates.items():
+            if entry is None:
+                metadata.pop(filename, None)
+            else:
+                metadata[filename] = entry
+        save_metadata(upload_folder, metadata)
+
+def update_file_metadata(space, filename, **fields):
+    """Merge fields into one file's metadata entry if the file is still listed."""
+    update_files_metadata(space, {filename: fields})
+
+def update_files_metadata(space, updates):
+    """Merge {filename: fields} into the entries still listed, in one save; None removes a field."""
+    upload_folder = os.path.join(BASE_UPLOAD_FOLDER, space)
+    with metadata_lock(upload_folder):
+        metadata = load_metadata(upload_folder)
+        changed = False
+        for filename, fields in updates.items():
+            if filename not in metadata:
+                continue
+            for key, value in fields.items():
+                if value is None:
+                    metadata[filename].pop(key, None)
+                else:
+                    metadata[filename][key] = value
+            changed = True
+        if changed:
+            save_metadata(upload_folder, metadata)
+
+def enqueue_job(space, filename, kind, payload=None):
+    """Queue a job, making sure something in this deployment will run it."""
+    global job_thread
+    job_queue.enqueue(space, filename, kind, payload)
+    if job_workers_started:
+        return
+    with job_thread_lock:
+        if job_thread is None:
+            job_thread = threading.Thread(target=worker_loop, args=(JOBS_DB, JOB_HANDLERS, JOB_FAILURE_HANDLERS),
+                                          daemon=True)
+            job_thread.start()
+
+def enqueue_processing(space, filename):
+    enqueue_job(space, filename, 'hash')
+    if SCAN_COMMAND:
+        enqueue_job(space, filename, 'scan')
+
+def file_digest(space, filename, meta=None, deferred=None):
+    """Return (size, mtime, sha256) of a local file, or None if it is missing.
+
+    The hash is cached in the metadata with the size and mtime it belongs to
+    and only recomputed when those no longer match the file. With a
+    ``deferred`` dict, new hashes are collected there for one
+    update_files_metadata() call instead of a metadata save per file.
+    """
+    file_path = os.path.join(BASE_UPLOAD_FOLDER, space, filename)
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    if meta is None:
+        meta = load_metadata(os.path.join(BASE_UPLOAD_FOLDER, space)).get(filename, {})
+    if meta.get('sha256') and meta.get('size') == st.st_size and meta.get('mtime') == st.st_mtime:
+        return st.st_size, st.st_mtime, meta['sha256']
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    fields = {'sha256': digest.hexdigest(), 'size': st.st_size, 'mtime': st.st_mtime}
+    if deferred is None:
+        update_files_metadata(space, {filename: fields})
+    else:
+        deferred[filename] = fields
+    return st.st_size, st.st_mtime, digest.hexdigest()
+
+def hash_job(job):
+    """Store the SHA-256 of an uploaded file, with the size and mtime it belongs to."""
+    file_digest(job['space'], job['filename'])
+
+def scan_job(job):
+    file_path = os.path.join(BASE_UPLOAD_FOLDER, job['space'], job['filename'])
+    if not os.path.isfile(file_path):
+        return
+    result = subprocess.run(shlex.split(SCAN_COMMAND) + [file_path], capture_output=True)
+    if result.returncode not in (0, 1):
+        raise RuntimeError(f'scanner exited with {result.returncode}: {result.stderr[-500:]!r}')
+    update_file_metadata(job['space'], job['filename'], scan='clean' if result.returncode == 0 else 'infected')
+    if result.returncode == 1:
+        log_action('worker', f"flagged infected {job['filename']} for {job['space']}")
+
+def zip_folder_job(job):
+    """Zip a folder upload saved in a temp folder into the space."""
+    upload_folder = os.path.join(BASE_UPLOAD_FOLDER, job['space'])
+    temp_folder = job['payload']['temp_folder']
+    zip_filename = job['filename']
+    if not os.path.isdir(temp_folder):
+        # Finished by an earlier attempt that died before reporting
+        if os.path.exists(os.path.join(upload_folder, zip_filename)):
+            return
+        raise FileNotFoundError(temp_folder)
+    # Build next to the temp folder so a half-written zip is never served
+    zip_tmp = shutil.make_archive(temp_folder, 'zip', temp_folder)
+    archive_file(upload_folder, zip_filename)
+    shutil.move(zip_tmp, os.path.join(upload_folder, zip_filename))
+    shutil.rmtree(temp_folder)
+    update_file_metadata(job['space'], zip_filename, pending=None)
+    change_log.record(job['space'], zip_filename)
+    log_action('worker', f"zipped folder {zip_filename} ({os.path.getsize(os.path.join(upload_folder, zip_filename))} bytes) for {job['space']}")
+    enqueue_processing(job['space'], zip_filename)
+
+def zip_folder_failed(job):
+    upload_folder = os.path.join(BASE_UPLOAD_FOLDER, job['space'])
+    with metadata_lock(upload_folder):
+        metadata = load_metadata(upload_folder)
+        if metadata.get(job['filename'], {}).get('pending'):
+            del metadata[job['filename']]
+            save_metadata(upload_folder, metadata)
+    shutil.rmtree(job['payload']['temp_folder'], ignore_errors=True)
+
+JOB_HANDLERS = {'hash': hash_job, 'scan': scan_job, 'zip_folder': zip_folder_job}
+JOB_FAILURE_HANDLERS = {'zip_folder': zip_folder_failed}
+
+def local_spaces():
+    if os.path.exists(BASE_UPLOAD_FOLDER):
+        return [d for d in os.listdir(BASE_UPLOAD_FOLDER)
+                if os.path.isdir(os.path.join(BASE_UPLOAD_FOLDER, d))]
+    return []
+
+def request_space():
+    """Return the space a request targets, or None for node-local routes."""
+    parts = request.path.strip('/').split('/')
+    if parts[0] == 'delete_space':
+        return parts[1] if len(parts) > 1 else None
+    if not parts[0] or parts[0] in CLUSTER_LOCAL_PREFIXES:
+        return None
+    return parts[0]
+
+def check_cluster_secret():
+    return not CLUSTER_SECRET or hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), CLUSTER_SECRET)
+
+def open_node_connection(node):
+    parsed = urllib.parse.urlsplit(node)
+    conn_class = http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
+    return conn_class(parsed.netloc, timeout=PROXY_TIMEOUT)
+
+def proxy_to(node):
+    """Forward the current request to another node and stream its response back."""
+    headers = {k: v for k, v in request.headers if k.lower() not in HOP_BY_HOP_HEADERS}
+    headers['X-Forwarded-For'] = request.remote_addr
+    headers[FORWARD_HEADER] = '1'
+    path = request.full_path if request.query_string else request.path
+    chunked = request.headers.get('Transfer-Encoding', '').lower() == 'chunked'
+    if chunked:
+        # Without a length the body can only be forwarded if the server decoded the chunks
+        if not request.environ.get('wsgi.input_terminated'):
+            return 'Length Required', 411
+        headers['Transfer-Encoding'] = 'chunked'
+        body = request.stream
+    else:
+        body = request.stream if request.content_length else None
+    conn = open_node_connection(node)
+    try:
+        conn.request(request.method, path, body=body, headers=headers, encode_chunked=chunked)
+        resp = conn.getresponse()
+    except OSError as e:
+        conn.close()
+        logging.warning(f"proxy to {node} failed: {e}")
+        return f'Node {node} is unavailable', 502
+
+    def generate():
+        try:
+            while True:
+                chunk = resp.read(64 * 1024)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            conn.close()
+    resp_headers = [(k, v) for k, v in resp.getheaders() if k.lower() not in HOP_BY_HOP_HEADERS]
+    return Response(generate(), status=resp.status, headers=resp_headers)
+
+@app.before_request
+def start_profile():
+    """Start timing the request; registered first so it covers the other hooks."""
+    header = request.headers.get(PROFILE_HEADER)
+    forced = bool(PROFILE_TOKEN) and header is not None and hmac.compare_digest(header, PROFILE_TOKEN)
+    g.profile = profiler.begin({
+        'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'method': request.method,
+        'path': request.full_path if request.query_string else request.path,
+        'endpoint': request.endpoint,
+        'ip': request.remote_addr,
+    }, forced)
+
+@app.before_request
+def route_to_owner():
+    """In cluster mode, send space requests to the node that owns the space."""
+    if hash_ring is None:
+        return None
+    if request.headers.get(FORWARD_HEADER) and request.remote_addr in cluster_addrs:
+        # Already forwarded by a member: serve here and never forward twice
+        if 'X-Forwarded-For' in request.headers:
+            request.remote_addr = request.headers['X-Forwarded-For']
+        return None
+    space = request_space()
+    if space is None:
+        return None
+    owner = hash_ring.node_for(space)
+    if owner == NODE_URL:
+        return None
+    if CLUSTER_REDIRECT:
+        return redirect(owner + (request.full_path if request.query_string else request.path), 307)
+    return proxy_to(owner)
+
+@app.before_request
+def shape_request():
+    """Apply request rate limits, and queue transfers for a per-client slot."""
+    ip = request.remote_addr
+    space = request_space()
+    shaper.throttle_request(ip, space)
+    if request.endpoint not in TRANSFER_ENDPOINTS:
+        return None
+    shaper.acquire_transfer(ip)
+    g.transfer_slot = True
+    if shaper.limits_bytes:
+        request.environ['wsgi.input'] = ThrottledReader(
+            request.environ['wsgi.input'], lambda n: shaper.throttle_bytes(ip, space, n))
+    return None
+
+@app.after_request
+def shape_response(response):
+    """Throttle the body of transfer responses and free the slot once it is sent."""
+    if not g.get('transfer_slot'):
+        return response
+    ip = request.remote_addr
+    space = request_space()
+    on_chunk = (lambda n: shaper.throttle_bytes(ip, space, n)) if shaper.limits_bytes else None
+    response.response = TransferBody(response.response, on_chunk, lambda: shaper.release_transfer(ip))
+    g.transfer_slot = False
+    return response
+
+@app.after_request
+def finish_profile(response):
+    """Save the capture once the body has been sent, so streaming time is included."""
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    profile.handler_end = time.perf_counter()
+    status = response.status_code
+    response.response = TransferBody(response.response, on_close=lambda: profiler.finish(profile, status))
+    return response
+
+@app.teardown_request
+def finish_failed_profile(exc):
+    # Only reached with the profile still open when the view failed
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profiler.finish(profile, 500)
+
+@app.teardown_request
+def release_transfer_slot(exc):
+    # Only reached with the slot still held when the view failed
+    if g.get('transfer_slot'):
+        shaper.release_transfer(request.remote_addr)
+
+def load_metadata(upload_folder):
+    """Return the metadata dict of a space, or an empty one."""
+    meta_file = os.path.join(upload_folder, META_FOLDER_NAME, META_FILE_NAME)
+    with phase('metadata'):
+        if os.path.exists(meta_file):
+            with open(meta_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return {}
+
+def save_metadata(upload_folder, metadata):
+    """Write the metadata of a space in one atomic replace."""
+    meta_folder = os.path.join(upload_folder, META_FOLDER_NAME)
+    os.makedirs(meta_folder, exist_ok=True)
+    meta_file = os.path.join(meta_folder, META_FILE_NAME)
+    tmp_file = meta_file + '.tmp'
+    with phase('metadata'):
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_file, meta_file)
+
+@contextlib.contextmanager
+def metadata_lock(upload_folder):
+    """Serialize read-modify-write of a space's metadata across threads and processes.
+
+    The lock file stays in place; the kernel releases the flock when its
+    holder closes it or dies, so there is no stale lock to take over.
+    """
+    meta_folder = os.path.join(upload_folder, META_FOLDER_NAME)
+    os.makedirs(meta_folder, exist_ok=True)
+    fd = os.open(os.path.join(meta_folder, 'metadata.lock'), os.O_CREAT | os.O_WRONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+def render_page(source, **context):
+    with phase('render'):
+        return render_template_string(source, **context)
+
+def is_safe_name(name):
+    """Reject names that would escape the space folder or hit internal folders."""
+    return (isinstance(name, str) and bool(name) and name == os.path.basename(name)
+            and name not in ('.', '..', META_FOLDER_NAME, VERSIONS_FOLDER_NAME))
 
 
 @app.route('/')
 def list_spaces():
     """Display all existing spaces with consistent styling."""
-    if os.path.exists(BASE_UPLOAD_FOLDER):
-        spaces = [d for d in os.listdir(BASE_UPLOAD_FOLDER)
-                  if os.path.isdir(os.path.join(BASE_UPLOAD_FOLDER, d))]
-    else:
-        spaces = []
+    spaces = local_spaces()
+    # In cluster mode, show the spaces held by every other member too
+    for node in CLUSTER_NODES:
+        if node == NODE_URL:
+            continue
+        try:
+            with urllib.request.urlopen(node + '/cluster/spaces', timeout=5) as resp:
+                spaces += [s for s in json.load(resp) if s not in spaces]
+        except OSError as e:
+            logging.warning(f"listing spaces on {node} failed: {e}")
     message = request.args.get('message')
-    return render_template_string('''
+    return render_page('''
     <!doctype html>
     <html>
     <head>
@@ -158,25 +712,22 @@ def index(username):
     os.makedirs(upload_folder, exist_ok=True)
     meta_folder = os.path.join(upload_folder, META_FOLDER_NAME)
     os.makedirs(meta_folder, exist_ok=True)
-    meta_file = os.path.join(meta_folder, META_FILE_NAME)
     comments_file = os.path.join(meta_folder, COMMENTS_FILE_NAME)
     
-    # Load metadata if exists
-    if os.path.exists(meta_file):
-        with open(meta_file, 'r',encoding='utf-8') as f:
-            metadata = json.load(f)
-    else:
-        metadata = {}
+    metadata = load_metadata(upload_folder)
 
-    files = {fname: meta for fname, meta in metadata.items()
-             if os.path.exists(os.path.join(upload_folder, fname))}
+    with phase('filesystem'):
+        files = {fname: meta for fname, meta in metadata.items()
+                 if meta.get('tier') == 'object' or meta.get('pending')
+                 or os.path.exists(os.path.join(upload_folder, fname))}
     
     # Load comments if exists
-    if os.path.exists(comments_file):
-        with open(comments_file, 'r',encoding='utf-8') as f:
-            comments = json.load(f)
-    else:
-        comments = []
+    with phase('metadata'):
+        if os.path.exists(comments_file):
+            with open(comments_file, 'r',encoding='utf-8') as f:
+                comments = json.load(f)
+        else:
+            comments = []
 
     log_action(request.remote_addr, f"view index for {username}")
 
@@ -185,7 +736,7 @@ def index(username):
         comments = comments[::-1]
     
     message = request.args.get('message')
-    return render_template_string('''
+    return render_page('''
     <!doctype html>
     <html>
     <head>
@@ -326,6 +877,7 @@ def index(username):
         <th>Filename</th>
         <th>Upload Time</th>
         <th>Upload IP</th>
+        <th>Processing</th>
         <th>Actions</th>
       </tr>
       {% for filename, meta in files.items() %}
@@ -333,11 +885,14 @@ def index(username):
         <td>{{ filename }}</td>
         <td>{{ meta['upload_time'] }}</td>
         <td>{{ meta['upload_ip'] }}</td>
+        <td class="processing-state">{% if meta.get('pending') %}queued{% endif %}</td>
         <td><a href="/{{ username }}/download/{{ filename }}">Download</a> - <a href="#" onclick="confirmDeletion('{{ filename }}')">Delete</a> - <a href="/{{ username }}/history/{{ filename }}">History</a></td>
       </tr>
       {% endfor %}
     </table>
     <input type=submit value="Download Selected" id="downloadSelectedButton" disabled class="disabled-upload-button">
+    <button type="button" id="deleteSelectedButton" onclick="deleteSelected()" disabled class="disabled-upload-button">Delete Selected</button>
+    <button type="button" id="moveSelectedButton" onclick="moveSelected()" disabled class="disabled-upload-button">Move Selected</button>
     </form>
     <form method=post action="/{{ username }}/clear">
       <input type=submit value="Clear All Files" onclick="return confirm('Are you sure you want to delete all files?');">
@@ -507,17 +1062,46 @@ function showCopyMessage(message) {
       }
 
       function updateDownloadButton() {
-        const btn = document.getElementById('downloadSelectedButton');
         const has = selectedFiles.size > 0;
-        btn.disabled = !has;
-        if (has) {
-          btn.classList.remove('disabled-upload-button');
-        } else {
-          btn.classList.add('disabled-upload-button');
-        }
+        ['downloadSelectedButton', 'deleteSelectedButton', 'moveSelectedButton'].forEach(id => {
+          const btn = document.getElementById(id);
+          btn.disabled = !has;
+          if (has) {
+            btn.classList.remove('disabled-upload-button');
+          } else {
+            btn.classList.add('disabled-upload-button');
+          }
+        });
         updateHiddenInputs();
       }
 
+      function bulkAction(actions) {
+        fetch(`/${username}/bulk`, {
+          method: 'POST',
+          headers: {'Content-Type': 'application/json'},
+          body: JSON.stringify({actions: actions})
+        }).then(r => r.json()).then(data => {
+          const failed = data.results.filter(r => !r.ok);
+          const message = failed.length
+            ? `${failed.length} of ${data.results.length} actions failed`
+            : 'Bulk operation completed successfully!';
+          window.location.href = `/${username}/?message=` + encodeURIComponent(message);
+        }).catch(err => alert('Bulk operation failed: ' + err));
+      }
+
+      function deleteSelected() {
+        if (confirm('Are you sure you want to delete ' + selectedFiles.size + ' selected files?')) {
+          bulkAction(Array.from(selectedFiles).map(f => ({op: 'delete', file: f})));
+        }
+      }
+
+      function moveSelected() {
+        const space = prompt('Move selected files to space:');
+        if (space) {
+          bulkAction(Array.from(selectedFiles).map(f => ({op: 'move', file: f, space: space})));
+        }
+      }
+
       const username = "{{ username }}";
 
       function hasDroppedFolder(files, items) {
@@ -624,7 +1208,23 @@ function showCopyMessage(message) {
         const files = document.getElementById('folderInput').files;
         uploadFolder(files);
       });
+      function refreshProcessingState() {
+        fetch(`/${username}/jobs`).then(r => r.json()).then(jobs => {
+          let busy = false;
+          document.querySelectorAll('#fileTable tr[data-filename]').forEach(row => {
+            const kinds = jobs[row.dataset.filename] || {};
+            const parts = Object.entries(kinds).map(([kind, job]) => kind + ': ' + job.status);
+            busy = busy || Object.values(kinds).some(job => job.status === 'queued' || job.status === 'running');
+            row.querySelector('.processing-state').textContent = parts.join(', ');
+          });
+          if (busy) {
+            setTimeout(refreshProcessingState, 2000);
+          }
+        });
+      }
+
       updateDownloadButton();
+      refreshProcessingState();
       var quill = new Quill('#editor', { theme: 'snow' });
       function submitComment() {
         document.getElementById('commentInput').value = quill.root.innerHTML;
@@ -645,7 +1245,6 @@ def upload_file(username):
     os.makedirs(upload_folder, exist_ok=True)
     meta_folder = os.path.join(upload_folder, META_FOLDER_NAME)
     os.makedirs(meta_folder, exist_ok=True)
-    meta_file = os.path.join(meta_folder, META_FILE_NAME)
     os.makedirs(os.path.join(upload_folder, VERSIONS_FOLDER_NAME), exist_ok=True)
     
     if 'file' not in request.files:
@@ -660,25 +1259,21 @@ def upload_file(username):
     for file in files:
         filename = file.filename
         file_path = os.path.join(upload_folder, filename)
-        if os.path.exists(file_path):
-            archive_file(upload_folder, filename)
-        file.save(file_path)
-        log_action(request.remote_addr, f"uploaded {filename} for {username}")
-        
-        # Load metadata
-        if os.path.exists(meta_file):
-            with open(meta_file, 'r',encoding='utf-8') as f:
-                metadata = json.load(f)
-        else:
-            metadata = {}
+        archive_file(upload_folder, filename)
+        with phase('io'):
+            file.save(file_path)
+        log_action(request.remote_addr, f"uploaded {filename} ({os.path.getsize(file_path)} bytes) for {username}")
         
-        # Save metadata
-        metadata[filename] = {
-            'upload_time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'),
-            'upload_ip': request.remote_addr
-        }
-        with open(meta_file, 'w',encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False,indent=4)
+        # Workers may be updating other entries of the same metadata
+        with metadata_lock(upload_folder):
+            metadata = load_metadata(upload_folder)
+            metadata[filename] = {
+                'upload_time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'),
+                'upload_ip': request.remote_addr
+            }
+            save_metadata(upload_folder, metadata)
+        change_log.record(username, filename)
+        enqueue_processing(username, filename)
     
     return f'<script>window.location.href = "/{username}/?message=File upload completed successfully!";</script>'
 
@@ -686,9 +1281,6 @@ def upload_file(username):
 def upload_folder(username):
     upload_folder = os.path.join(BASE_UPLOAD_FOLDER, username)
     os.makedirs(upload_folder, exist_ok=True)
-    meta_folder = os.path.join(upload_folder, META_FOLDER_NAME)
-    os.makedirs(meta_folder, exist_ok=True)
-    meta_file = os.path.join(meta_folder, META_FILE_NAME)
     os.makedirs(os.path.join(upload_folder, VERSIONS_FOLDER_NAME), exist_ok=True)
     
     if 'file' not in request.files:
@@ -700,49 +1292,562 @@ def upload_folder(username):
         log_action(request.remote_addr, f"upload_folder no selected folder for {username}")
         return 'No selected folder'
     
-    temp_folder = os.path.join(TEMP_UPLOAD_FOLDER, username)
-    os.makedirs(temp_folder, exist_ok=True)
+    # A temp folder per upload, since zipping happens later in a worker
+    temp_folder = tempfile.mkdtemp(prefix=f'{username}_', dir=TEMP_UPLOAD_FOLDER)
 
-    for file in files:
-        file_path = os.path.join(temp_folder, file.filename)
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        file.save(file_path)
+    total_size = 0
+    with phase('io'):
+        for file in files:
+            file_path = os.path.join(temp_folder, file.filename)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            file.save(file_path)
+            total_size += os.path.getsize(file_path)
     
-    # Create a ZIP file from the uploaded folder with the original folder name
+    # The ZIP file is named after the original folder
     original_folder_name = os.path.commonpath([file.filename for file in files]).split(os.sep)[0]
     timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
     zip_filename = f"{original_folder_name}_{timestamp}.zip"
-    zip_filepath = os.path.join(upload_folder, zip_filename)
-    if os.path.exists(zip_filepath):
-        archive_file(upload_folder, zip_filename)
-    shutil.make_archive(zip_filepath[:-4], 'zip', temp_folder)
-    log_action(request.remote_addr, f"uploaded folder {zip_filename} for {username}")
-
-    # Remove the temporary files
-    shutil.rmtree(temp_folder)
+    log_action(request.remote_addr, f"uploaded folder {zip_filename} ({total_size} bytes) for {username}")
 
-    # Load metadata
-    if os.path.exists(meta_file):
-        with open(meta_file, 'r') as f:
-            metadata = json.load(f)
-    else:
-        metadata = {}
-    
-    # Save metadata
-    metadata[zip_filename] = {
-        'upload_time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'),
-        'upload_ip': request.remote_addr
-    }
-    with open(meta_file, 'w',encoding='utf-8') as f:
-        json.dump(metadata, f, ensure_ascii=False)
+    # Listed as pending until the worker has written the zip
+    with metadata_lock(upload_folder):
+        metadata = load_metadata(upload_folder)
+        metadata[zip_filename] = {
+            'upload_time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'),
+            'upload_ip': request.remote_addr,
+            'pending': True
+        }
+        save_metadata(upload_folder, metadata)
+    enqueue_job(username, zip_filename, 'zip_folder', {'temp_folder': os.path.abspath(temp_folder)})
     
     return f'<script>window.location.href = "/{username}/?message=Folder upload completed successfully!";</script>'
 
+def install_file(space, filename, tmp_path, ip):
+    """Move a fully written temp file into a space; the previous version becomes history."""
+    upload_folder = os.path.join(BASE_UPLOAD_FOLDER, space)
+    archive_file(upload_folder, filename)
+    os.replace(tmp_path, os.path.join(upload_folder, filename))
+    with metadata_lock(upload_folder):
+        metadata = load_metadata(upload_folder)
+        metadata[filename] = {
+            'upload_time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'),
+            'upload_ip': ip
+        }
+        save_metadata(upload_folder, metadata)
+    change_log.record(space, filename)
+    enqueue_processing(space, filename)
+
+def file_etag(path):
+    st = os.stat(path)
+    return f'{st.st_size}-{st.st_mtime_ns}'
+
+@app.route('/<username>/signature/<filename>')
+def signature(username, filename):
+    """Block signatures of the current file, for delta uploads (see delta.py)."""
+    upload_folder = os.path.join(BASE_UPLOAD_FOLDER, username)
+    file_path = os.path.join(upload_folder, filename)
+    if not is_safe_name(filename) or not os.path.isfile(file_path):
+        return jsonify({'error': 'File not found'}), 404
+    block_size = request.args.get('block_size', type=int)
+    if block_size is not None:
+        block_size = max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+    etag = file_etag(file_path)
+
+    # Signatures are cached per file until it changes
+    cache_folder = os.path.join(upload_folder, META_FOLDER_NAME, SIGNATURES_FOLDER_NAME)
+    cache_file = os.path.join(cache_folder, filename + '.json')
+    sig = None
+    if os.path.exists(cache_file):
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached.get('basis') == etag and block_size in (None, cached['block_size']):
+            sig = cached
+    if sig is None:
+        with phase('io'):
+            sig = file_signature(file_path, block_size)
+        sig['basis'] = etag
+        os.makedirs(cache_folder, exist_ok=True)
+        with open(cache_file, 'w', encoding='utf-8') as f:
+            json.dump(sig, f)
+    log_action(request.remote_addr, f"signature {filename} for {username}")
+    return jsonify(sig)
+
+@app.route('/<username>/delta/<filename>', methods=['POST'])
+def delta_upload(username, filename):
+    """Rebuild a file from its current version plus the delta in the request body."""
+    if not is_safe_name(filename):
+        return jsonify({'error': 'Invalid filename'}), 400
+    upload_folder = os.path.join(BASE_UPLOAD_FOLDER, username)
+    meta_folder = os.path.join(upload_folder, META_FOLDER_NAME)
+    os.makedirs(meta_folder, exist_ok=True)
+    file_path = os.path.join(upload_folder, filename)
+
+    basis = request.args.get('basis', '')
+    basis_path = None
+    if basis:
+        if not os.path.isfile(file_path) or file_etag(file_path) != basis:
+            log_action(request.remote_addr, f"delta upload with stale basis {filename} for {username}")
+            return jsonify({'error': 'Basis changed, fetch a new signature'}), 409
+        basis_path = file_path
+
+    fd, tmp_path = tempfile.mkstemp(prefix='.delta_', dir=meta_folder)
+    try:
+        with os.fdopen(fd, 'wb') as out, phase('io'):
+            literal_bytes, copied_bytes = apply_delta(basis_path, request.stream, out)
+    except DeltaError as e:
+        os.remove(tmp_path)
+        log_action(request.remote_addr, f"rejected delta upload {filename} for {username}: {e}")
+        return jsonify({'error': str(e)}), 400
+    except BaseException:
+        # Client disconnects and disk errors must not leave the partial file behind
+        os.remove(tmp_path)
+        raise
+
+    install_file(username, filename, tmp_path, request.remote_addr)
+    log_action(request.remote_addr, f"uploaded {filename} by delta ({literal_bytes} bytes) for {username}")
+    return jsonify({'size': os.path.getsize(file_path), 'literal_bytes': literal_bytes, 'copied_bytes': copied_bytes})
+
+DAV_METHODS = ['OPTIONS', 'PROPFIND', 'GET', 'PUT', 'DELETE', 'MOVE', 'COPY', 'MKCOL']
+
+def dav_href(space, filename=''):
+    return f'/{urllib.parse.quote(space)}/dav/{urllib.parse.quote(filename)}'
+
+def dav_entry(href, name, size=None, mtime=None, etag=None):
+    """One <D:response> of a PROPFIND reply; a size of None means the space itself."""
+    props = [f'<D:displayname>{xml_escape(name)}</D:displayname>']
+    if mtime is not None:
+        props.append(f'<D:getlastmodified>{email.utils.formatdate(mtime, usegmt=True)}</D:getlastmodified>')
+    if size is None:
+        props.append('<D:resourcetype><D:collection/></D:resourcetype>')
+    else:
+        mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        props += ['<D:resourcetype/>', f'<D:getcontentlength>{size}</D:getcontentlength>',
+                  f'<D:getcontenttype>{xml_escape(mimetype)}</D:getcontenttype>']
+        if etag:
+            props.append(f'<D:getetag>"{xml_escape(etag)}"</D:getetag>')
+    return (f'<D:response><D:href>{xml_escape(href)}</D:href><D:propstat><D:prop>{"".join(props)}</D:prop>'
+            '<D:status>HTTP/1.1 200 OK</D:status></D:propstat></D:response>\n')
+
+def dav_file_stat(space, filename, meta):
+    """(size, mtime, etag) of a listed file, or None if it is gone.
+
+    Taken from the metadata once the hash job has filled it in, so listing a
+    processed space needs no filesystem or object store calls.
+    """
+    if 'size' in meta and 'mtime' in meta:
+        return meta['size'], meta['mtime'], meta.get('sha256')
+    key = storage_key(space, filename)
+    if meta.get('tier') == 'object':
+        if object_storage is None or not object_storage.exists(key):
+            return None
+        return object_storage.size(key), object_storage.getmtime(key), None
+    try:
+        return os.path.getsize(local_storage.path(key)), local_storage.getmtime(key), file_etag(local_storage.path(key))
+    except FileNotFoundError:
+        return None
+
+def dav_propfind(username, filename):
+    upload_folder = os.path.join(BASE_UPLOAD_FOLDER, username)
+    metadata = load_metadata(upload_folder)
+    if filename:
+        meta = metadata.get(filename)
+        stat = dav_file_stat(username, filename, meta) if meta and not meta.get('pending') else None
+        if stat is None:
+            return 'Not Found', 404
+        names = [filename]
+        head = ''
+    else:
+        # Spaces are flat, so Depth: infinity is the same as Depth: 1
+        depth = request.headers.get('Depth', 'infinity')
+        names = [] if depth == '0' else sorted(n for n, m in metadata.items() if not m.get('pending'))
+        # Optional paging for scripted clients: ?offset=N&limit=M
+        offset = request.args.get('offset', 0, type=int)
+        limit = request.args.get('limit', type=int)
+        names = names[offset:offset + limit if limit else None]
+        head = dav_entry(dav_href(username), username)
+    log_action(request.remote_addr, f"propfind {filename or '/'} ({len(names)} entries) for {username}")
+
+    def generate():
+        yield '<?xml version="1.0" encoding="utf-8"?>\n<D:multistatus xmlns:D="DAV:">\n' + head
+        for name in names:
+            stat = dav_file_stat(username, name, metadata[name])
+            if stat is not None:
+                yield dav_entry(dav_href(username, name), name, *stat)
+        yield '</D:multistatus>\n'
+    return Response(generate(), 207, mimetype='application/xml')
+
+def dav_put(username, filename):
+    upload_folder = os.path.join(BASE_UPLOAD_FOLDER, username)
+    meta_folder = os.path.join(upload_folder, META_FOLDER_NAME)
+    os.makedirs(meta_folder, exist_ok=True)
+    existed = find_storage(storage_key(username, filename)) is not None
+    # Written aside first so a broken upload never replaces the current file
+    fd, tmp_path = tempfile.mkstemp(prefix='.put_', dir=meta_folder)
+    try:
+        with os.fdopen(fd, 'wb') as out, phase('io'):
+            shutil.copyfileobj(request.stream, out, 1024 * 1024)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    size = os.path.getsize(tmp_path)
+    install_file(username, filename, tmp_path, request.remote_addr)
+    log_action(request.remote_addr, f"uploaded {filename} via WebDAV ({size} bytes) for {username}")
+    return '', 204 if existed else 201
+
+def dav_delete(username, filename):
+    upload_folder = os.path.join(BASE_UPLOAD_FOLDER, username)
+    if find_storage(storage_key(username, filename)) is None:
+        return 'Not Found', 404
+    archive_file(upload_folder, filename)
+    with metadata_lock(upload_folder):
+        metadata = load_metadata(upload_folder)
+        if metadata.pop(filename, None) is not None:
+            save_metadata(upload_folder, metadata)
+    change_log.record(username, filename, 'delete')
+    log_action(request.remote_addr, f"deleted {filename} via WebDAV for {username}")
+    return '', 204
+
+def dav_transfer(username, filename, copy):
+    """MOVE (a rename, or a move to another space on this node) or COPY."""
+    parts = urllib.parse.unquote(urllib.parse.urlsplit(request.headers.get('Destination', '')).path).strip('/').split('/')
+    if len(parts) != 3 or parts[1] != 'dav' or not is_safe_name(parts[0]) or not is_safe_name(parts[2]):
+        return 'Invalid Destination', 400
+    space, new_name = parts[0], parts[2]
+    if hash_ring is not None and hash_ring.node_for(space) != NODE_URL:
+        return 'Destination space is on another node', 502
+    key = storage_key(username, filename)
+    storage = find_storage(key)
+    if storage is None:
+        return 'Not Found', 404
+    if (space, new_name) == (username, filename):
+        return 'Source and destination are the same', 403
+    existed = find_storage(storage_key(space, new_name)) is not None
+    if existed and request.headers.get('Overwrite', 'T').upper() == 'F':
+        return 'Destination exists', 412
+
+    upload_folder = os.path.join(BASE_UPLOAD_FOLDER, username)
+    target_folder = os.path.join(BASE_UPLOAD_FOLDER, space)
+    os.makedirs(os.path.join(target_folder, META_FOLDER_NAME), exist_ok=True)
+    if copy:
+        fd, tmp_path = tempfile.mkstemp(prefix='.copy_', dir=os.path.join(target_folder, META_FOLDER_NAME))
+        os.close(fd)
+        with phase('io'):
+            if storage is local_storage:
+                shutil.copyfile(local_storage.path(key), tmp_path)
+            else:
+                object_storage.download(key, tmp_path)
+        install_file(space, new_name, tmp_path, request.remote_addr)
+    else:
+        # An overwritten destination is kept as history, as with a bulk rename
+        archive_file(target_folder, new_name)
+        storage.move(key, storage_key(space, new_name))
+        if space != username and new_name == filename:
+            move_versions(username, space, filename)
+        with metadata_lock(upload_folder):
+            metadata = load_metadata(upload_folder)
+            entry = metadata.pop(filename, None)
+            save_metadata(upload_folder, metadata)
+        with metadata_lock(target_folder):
+            metadata = load_metadata(target_folder)
+            metadata[new_name] = entry or {
+                'upload_time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'),
+                'upload_ip': request.remote_addr
+            }
+            save_metadata(target_folder, metadata)
+        change_log.record(username, filename, 'delete')
+        change_log.record(space, new_name)
+    log_action(request.remote_addr, f"{'copied' if copy else 'moved'} {filename} to {space}/{new_name} via WebDAV for {username}")
+    return '', 204 if existed else 201
+
+@app.route('/<username>/dav', methods=DAV_METHODS)
+@app.route('/<username>/dav/', methods=DAV_METHODS)
+@app.route('/<username>/dav/<filename>', methods=DAV_METHODS)
+def webdav(username, filename=None):
+    """WebDAV class 1 view of a space, for rclone and OS clients.
+
+    Spaces are flat: the space is the only collection and MKCOL is refused.
+    """
+    if request.method == 'OPTIONS':
+        return Response('', headers={'DAV': '1', 'MS-Author-Via': 'DAV', 'Allow': ', '.join(DAV_METHODS + ['HEAD'])})
+    if request.method == 'PROPFIND':
+        return dav_propfind(username, filename)
+    if filename is None:
+        if request.method in ('GET', 'HEAD'):
+            return redirect(f'/{username}/')
+        return 'Spaces have no subfolders', 405
+    if not is_safe_name(filename):
+        return 'Invalid filename', 403
+    if request.method in ('GET', 'HEAD'):
+        return download_file(username, filename)
+    if request.method == 'PUT':
+        return dav_put(username, filename)
+    if request.method == 'DELETE':
+        return dav_delete(username, filename)
+    if request.method in ('MOVE', 'COPY'):
+        return dav_transfer(username, filename, request.method == 'COPY')
+    return 'Spaces have no subfolders', 405
+
+def object_member(key):
+    """Open an object-tier file for iter_tar."""
+    def open_member():
+        if not object_storage.exists(key):
+            return None
+        return object_storage.size(key), object_storage.getmtime(key), object_storage.open(key)
+    return open_member
+
+def export_members(username, versions, meta):
+    """(arcname, open_member) pairs for every file of a space, in either tier."""
+    upload_folder = os.path.join(BASE_UPLOAD_FOLDER, username)
+    for filename, entry in sorted(load_metadata(upload_folder).items()):
+        if entry.get('pending'):
+            continue
+        key = storage_key(username, filename)
+        if entry.get('tier') == 'object' and object_storage is not None:
+            yield filename, object_member(key)
+        else:
+            yield filename, lambda path=local_storage.path(key): local_member(path)
+    if versions:
+        prefix = storage_key(username, VERSIONS_FOLDER_NAME) + '/'
+        for tier in (local_storage, object_storage):
+            if tier is None:
+                continue
+            for key in sorted(tier.list(prefix)):
+                arcname = key.split('/', 1)[1]
+                # Only .versions/<file>/<version>; skips restore staging files
+                if arcname.count('/') != 2:
+                    continue
+                if tier is local_storage:
+                    yield arcname, lambda path=local_storage.path(key): local_member(path)
+                else:
+                    yield arcname, object_member(key)
+    if meta:
+        for name in (META_FILE_NAME, COMMENTS_FILE_NAME):
+            path = os.path.join(upload_folder, META_FOLDER_NAME, name)
+            yield f'{META_FOLDER_NAME}/{name}', lambda path=path: local_member(path)
+
+@app.route('/<username>/export')
+def export_space(username):
+    """Stream the whole space as a tar, without buffering.
+
+    ``?versions=1`` adds .versions, ``?meta=0`` leaves out .meta and
+    ``?compress=zstd`` compresses with FTP_EXPORT_ZSTD_THREADS threads.
+    """
+    upload_folder = os.path.join(BASE_UPLOAD_FOLDER, username)
+    if not os.path.isdir(upload_folder):
+        return 'Space not found', 404
+    compress = request.args.get('compress', '')
+    if compress not in ('', 'zstd'):
+        return 'Unknown compression', 400
+    if compress and not ZSTD_AVAILABLE:
+        return 'zstd compression needs the zstandard package', 400
+    chunks = iter_tar(export_members(username, request.args.get('versions') == '1',
+                                     request.args.get('meta', '1') != '0'))
+    if compress:
+        chunks = compress_zstd(chunks, EXPORT_ZSTD_LEVEL, EXPORT_ZSTD_THREADS)
+    ip = request.remote_addr
+
+    def generate():
+        sent = 0
+        try:
+            for chunk in chunks:
+                sent += len(chunk)
+                yield chunk
+        finally:
+            log_action(ip, f"exported space ({sent} bytes) for {username}")
+    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    download_name = f"{username}_{timestamp}.tar{'.zst' if compress else ''}"
+    resp = Response(generate(), mimetype='application/zstd' if compress else 'application/x-tar')
+    resp.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{urllib.parse.quote(download_name)}"
+    return resp
+
+def merge_staged_space(space, staging, ip, keep_all_metadata=False):
+    """Move a space unpacked into ``staging`` into place. Returns (files, version count, bytes).
+
+    Files it replaces are kept as history. Only entries of the files moved
+    in are merged into the metadata, as local files, unless
+    ``keep_all_metadata`` (a whole space handed over by another node, whose
+    object-tier files stay in the shared bucket).
+    """
+    upload_folder = os.path.join(BASE_UPLOAD_FOLDER, space)
+    imported = []
+    total_size = versions = 0
+    for name in sorted(os.listdir(staging)):
+        path = os.path.join(staging, name)
+        if not is_safe_name(name) or not os.path.isfile(path):
+            continue
+        total_size += os.path.getsize(path)
+        archive_file(upload_folder, name)
+        os.replace(path, os.path.join(upload_folder, name))
+        imported.append(name)
+
+    staged_versions = os.path.join(staging, VERSIONS_FOLDER_NAME)
+    for filename in os.listdir(staged_versions) if os.path.isdir(staged_versions) else []:
+        src_folder = os.path.join(staged_versions, filename)
+        if not is_safe_name(filename) or not os.path.isdir(src_folder):
+            continue
+        dst_folder = os.path.join(upload_folder, VERSIONS_FOLDER_NAME, filename)
+        os.makedirs(dst_folder, exist_ok=True)
+        for version in os.listdir(src_folder):
+            os.replace(os.path.join(src_folder, version), os.path.join(dst_folder, version))
+            versions += 1
+
+    # Incoming entries win over existing ones
+    incoming = load_metadata(staging)
+    if keep_all_metadata:
+        updates = incoming
+    else:
+        updates = {}
+        for name in imported:
+            entry = dict(incoming.get(name) or {
+                'upload_time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'),
+                'upload_ip': ip
+            })
+            entry.pop('tier', None)
+            entry.pop('pending', None)
+            updates[name] = entry
+    merge_metadata(space, updates)
+
+    staged_comments = os.path.join(staging, META_FOLDER_NAME, COMMENTS_FILE_NAME)
+    if os.path.exists(staged_comments):
+        comments_file = os.path.join(upload_folder, META_FOLDER_NAME, COMMENTS_FILE_NAME)
+        comments = []
+        if os.path.exists(comments_file):
+            with open(comments_file, 'r', encoding='utf-8') as f:
+                comments = json.load(f)
+        with open(staged_comments, 'r', encoding='utf-8') as f:
+            comments += [c for c in json.load(f) if c not in comments]
+        with open(comments_file, 'w', encoding='utf-8') as f:
+            json.dump(comments, f, indent=4, ensure_ascii=False)
+    return imported, versions, total_size
+
+@app.route('/<username>/import', methods=['POST'])
+def import_space(username):
+    """Merge a tar made by /export (plain or compressed) into the space.
+
+    The tar is unpacked to a staging folder on the same disk and moved in;
+    files it replaces are kept as history, as with an upload.
+    """
+    upload_folder = os.path.join(BASE_UPLOAD_FOLDER, username)
+    meta_folder = os.path.join(upload_folder, META_FOLDER_NAME)
+    os.makedirs(meta_folder, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix='.import_', dir=meta_folder)
+    try:
+        try:
+            with phase('io'):
+                unpack_space(open_archive(request.stream), staging)
+        except ARCHIVE_ERRORS as e:
+            log_action(request.remote_addr, f"rejected import for {username}: {e}")
+            return jsonify({'error': f'Invalid archive: {e}'}), 400
+
+        imported, versions, total_size = merge_staged_space(username, staging, request.remote_addr)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    for name in imported:
+        change_log.record(username, name)
+        enqueue_processing(username, name)
+    log_action(request.remote_addr, f"imported {len(imported)} files and {versions} versions ({total_size} bytes) for {username}")
+    return jsonify({'files': len(imported), 'versions': versions, 'bytes': total_size})
+
+def manifest_entry(space, filename, meta, deferred):
+    """{'size', 'mtime', 'sha256'} of a listed file, or None if it is not there yet."""
+    if meta.get('pending'):
+        return None
+    if meta.get('tier') == 'object':
+        if 'size' in meta and 'mtime' in meta:
+            return {'size': meta['size'], 'mtime': meta['mtime'], 'sha256': meta.get('sha256')}
+        key = storage_key(space, filename)
+        if object_storage is None or not object_storage.exists(key):
+            return None
+        return {'size': object_storage.size(key), 'mtime': object_storage.getmtime(key), 'sha256': None}
+    digest = file_digest(space, filename, meta, deferred)
+    if digest is None:
+        return None
+    return dict(zip(('size', 'mtime', 'sha256'), digest))
+
+@app.route('/<username>/manifest')
+def manifest(username):
+    """Size, mtime, SHA-256 and change sequence of every file, and the latest sequence.
+
+    Files not changed since change tracking started have sequence 0. Pass
+    the returned ``seq`` to /changes to follow later changes, as long as
+    /changes reports the same ``epoch``.
+    """
+    upload_folder = os.path.join(BASE_UPLOAD_FOLDER, username)
+    # Read first, so any change made while building the manifest is after it
+    epoch = change_log.epoch(username)
+    seq = change_log.latest(username)
+    sequences = change_log.sequences(username)
+    files = {}
+    # Hashes computed here are saved together once the listing is done
+    deferred = {}
+    with phase('filesystem'):
+        for filename, meta in sorted(load_metadata(upload_folder).items()):
+            entry = manifest_entry(username, filename, meta, deferred)
+            if entry is not None:
+                entry['seq'] = sequences.get(filename, 0)
+                files[filename] = entry
+    if deferred:
+        update_files_metadata(username, deferred)
+    log_action(request.remote_addr, f"manifest ({len(files)} files) for {username}")
+    return jsonify({'space': username, 'epoch': epoch, 'seq': seq, 'files': files})
+
+@app.route('/<username>/changes')
+def list_changes(username):
+    """Latest change of each file changed after ``?since=``, oldest first.
+
+    Each change has file, op ("put" or "delete") and seq; puts also carry
+    the manifest fields of the file. At most ``?limit=`` (default 1000) are
+    returned; ask again from the returned ``seq`` while ``more`` is true.
+    """
+    upload_folder = os.path.join(BASE_UPLOAD_FOLDER, username)
+    epoch = change_log.epoch(username)
+    since = request.args.get('since', 0, type=int)
+    limit = max(1, min(request.args.get('limit', 1000, type=int), 10000))
+    rows = change_log.since(username, since, limit + 1)
+    more = len(rows) > limit
+    rows = rows[:limit]
+    metadata = load_metadata(upload_folder) if rows else {}
+    result = []
+    deferred = {}
+    with phase('filesystem'):
+        for row in rows:
+            change = {'file': row['filename'], 'op': row['op'], 'seq': row['seq']}
+            if row['op'] == 'put':
+                entry = manifest_entry(username, row['filename'], metadata[row['filename']], deferred) if row['filename'] in metadata else None
+                if entry is None:
+                    # Removed or replaced just now; its next change follows
+                    continue
+                change.update(entry)
+            result.append(change)
+    if deferred:
+        update_files_metadata(username, deferred)
+    log_action(request.remote_addr, f"changes since {since} ({len(result)} changes) for {username}")
+    return jsonify({'space': username, 'epoch': epoch, 'seq': rows[-1]['seq'] if rows else since,
+                    'more': more, 'changes': result})
+
+@app.route('/<username>/jobs')
+def job_status(username):
+    """Processing state of each file: {filename: {kind: {status, attempts, error}}}."""
+    return jsonify(job_queue.status(username))
+
 @app.route('/<username>/download/<filename>')
 def download_file(username, filename):
     upload_folder = os.path.join(BASE_UPLOAD_FOLDER, username)
-    log_action(request.remote_addr, f"downloaded {filename} for {username}")
-    return send_from_directory(upload_folder, filename)
+    key = storage_key(username, filename)
+    storage = find_storage(key)
+    if storage is not None and storage is object_storage:
+        response = send_from_object_storage(key, filename)
+    else:
+        response = send_from_directory(os.path.abspath(upload_folder), filename)
+    if request.method == 'HEAD':
+        # WebDAV clients probe files constantly; those are not downloads
+        log_action(request.remote_addr, f"checked {filename} for {username}")
+    else:
+        # Only the requested range is sent, and nothing for 304 Not Modified
+        size = (response.content_length or 0) if response.status_code in (200, 206) else 0
+        log_action(request.remote_addr, f"downloaded {filename} ({size} bytes) for {username}")
+    return response
 
 @app.route('/<username>/download_batch', methods=['POST'])
 def download_batch(username):
@@ -753,70 +1858,65 @@ def download_batch(username):
         return f'<script>window.location.href = "/{username}/?message=No files selected!";</script>'
 
     mem = io.BytesIO()
-    with zipfile.ZipFile(mem, 'w') as zf:
+    with phase('io'), zipfile.ZipFile(mem, 'w') as zf:
         for fname in selected_files:
             file_path = os.path.join(upload_folder, fname)
             if os.path.isfile(file_path):
                 zf.write(file_path, arcname=fname)
+            elif object_storage is not None and object_storage.exists(storage_key(username, fname)):
+                with zf.open(fname, 'w') as dst:
+                    for chunk in object_storage.open(storage_key(username, fname)):
+                        dst.write(chunk)
     mem.seek(0)
     timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-    log_action(request.remote_addr, f"downloaded batch {selected_files} for {username}")
+    log_action(request.remote_addr, f"downloaded batch {selected_files} ({mem.getbuffer().nbytes} bytes) for {username}")
     return send_file(mem, download_name=f'selected_{timestamp}.zip', as_attachment=True, mimetype='application/zip')
 
 @app.route('/<username>/history/<filename>')
 def file_history(username, filename):
     upload_folder = os.path.join(BASE_UPLOAD_FOLDER, username)
-    versions_dir = os.path.join(upload_folder, VERSIONS_FOLDER_NAME, filename)
-    if not os.path.isdir(versions_dir):
+    prefix = storage_key(username, VERSIONS_FOLDER_NAME, filename) + '/'
+    keys = local_storage.list(prefix)
+    if object_storage is not None:
+        keys += object_storage.list(prefix)
+    if not keys:
         return f'<script>window.location.href = "/{username}/?message=No history for {filename}!";</script>'
-    versions = sorted(os.listdir(versions_dir), reverse=True)
+    versions = sorted((k.rsplit('/', 1)[1] for k in keys), reverse=True)
     items = ''.join(f'<li>{v} - <a href="/{username}/restore/{filename}/{v}">Restore</a></li>' for v in versions)
     return f'<h1>History for {filename}</h1><ul>{items}</ul><a href="/{username}/">Back</a>'
 
 @app.route('/<username>/restore/<filename>/<version>')
 def restore_version(username, filename, version):
     upload_folder = os.path.join(BASE_UPLOAD_FOLDER, username)
-    versions_dir = os.path.join(upload_folder, VERSIONS_FOLDER_NAME, filename)
-    version_path = os.path.join(versions_dir, version)
-    if not os.path.exists(version_path):
+    staged_path = stage_version(upload_folder, filename, version)
+    if staged_path is None:
         log_action(request.remote_addr, f"attempted restore of missing {filename} {version} for {username}")
         return f'<script>window.location.href = "/{username}/?message=Version not found!";</script>'
-    if os.path.exists(os.path.join(upload_folder, filename)):
-        archive_file(upload_folder, filename)
-    shutil.move(version_path, os.path.join(upload_folder, filename))
-    meta_folder = os.path.join(upload_folder, META_FOLDER_NAME)
-    os.makedirs(meta_folder, exist_ok=True)
-    meta_file = os.path.join(meta_folder, META_FILE_NAME)
-    metadata = {}
-    if os.path.exists(meta_file):
-        with open(meta_file, 'r', encoding='utf-8') as f:
-            metadata = json.load(f)
-    metadata[filename] = {
-        'upload_time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'),
-        'upload_ip': request.remote_addr
-    }
-    with open(meta_file, 'w', encoding='utf-8') as f:
-        json.dump(metadata, f, ensure_ascii=False, indent=4)
+    archive_file(upload_folder, filename)
+    shutil.move(staged_path, os.path.join(upload_folder, filename))
+    with metadata_lock(upload_folder):
+        metadata = load_metadata(upload_folder)
+        metadata[filename] = {
+            'upload_time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'),
+            'upload_ip': request.remote_addr
+        }
+        save_metadata(upload_folder, metadata)
+    change_log.record(username, filename)
     log_action(request.remote_addr, f"restored {filename} version {version} for {username}")
     return f'<script>window.location.href = "/{username}/?message=File restored successfully!";</script>'
 
 @app.route('/<username>/delete/<filename>', methods=['GET'])
 def delete_file(username, filename):
     upload_folder = os.path.join(BASE_UPLOAD_FOLDER, username)
-    meta_folder = os.path.join(upload_folder, META_FOLDER_NAME)
-    meta_file = os.path.join(meta_folder, META_FILE_NAME)
-    file_path = os.path.join(upload_folder, filename)
 
-    if os.path.exists(file_path):
+    if find_storage(storage_key(username, filename)) is not None:
         archive_file(upload_folder, filename)
         # Remove metadata
-        if os.path.exists(meta_file):
-            with open(meta_file, 'r',encoding='utf-8') as f:
-                metadata = json.load(f)
-            if filename in metadata:
-                del metadata[filename]
-                with open(meta_file, 'w',encoding='utf-8') as f:
-                    json.dump(metadata, f, ensure_ascii=False, indent=4)
+        with metadata_lock(upload_folder):
+            metadata = load_metadata(upload_folder)
+            if metadata.pop(filename, None) is not None:
+                save_metadata(upload_folder, metadata)
+        change_log.record(username, filename, 'delete')
         log_action(request.remote_addr, f"deleted {filename} for {username}")
         return f'<script>window.location.href = "/{username}/?message=File deleted successfully!";</script>'
     else:
@@ -826,8 +1926,8 @@ def delete_file(username, filename):
 @app.route('/<username>/clear', methods=['POST'])
 def clear_files(username):
     upload_folder = os.path.join(BASE_UPLOAD_FOLDER, username)
-    meta_folder = os.path.join(upload_folder, META_FOLDER_NAME)
-    meta_file = os.path.join(meta_folder, META_FILE_NAME)
+    listed = load_metadata(upload_folder)
+    cleared = set(listed)
 
     # Delete all files in the folder
     for filename in os.listdir(upload_folder):
@@ -836,14 +1936,146 @@ def clear_files(username):
         file_path = os.path.join(upload_folder, filename)
         if os.path.isfile(file_path):
             archive_file(upload_folder, filename)
+            change_log.record(username, filename, 'delete')
+            cleared.add(filename)
+    for filename, meta in listed.items():
+        if meta.get('tier') == 'object':
+            archive_file(upload_folder, filename)
+            change_log.record(username, filename, 'delete')
     
-    # Clear metadata
-    if os.path.exists(meta_file):
-        os.remove(meta_file)
+    # Clear metadata, keeping entries of uploads that finished meanwhile
+    with metadata_lock(upload_folder):
+        metadata = load_metadata(upload_folder)
+        save_metadata(upload_folder, {k: v for k, v in metadata.items() if k not in cleared})
     
     log_action(request.remote_addr, f"cleared all files for {username}")
     return f'<script>window.location.href = "/{username}/?message=All files deleted successfully!";</script>'
 
+@app.route('/<username>/bulk', methods=['POST'])
+def bulk_operations(username):
+    """Apply a list of delete/restore/rename/move actions, saving the metadata once.
+
+    Each action succeeds or reports its own error; the metadata of every
+    action carried out is saved even if a later one fails.
+
+    Body: ``{"actions": [{"op": "delete", "file": "a.txt"},
+    {"op": "restore", "file": "a.txt", "version": "..."},
+    {"op": "rename", "file": "a.txt", "to": "b.txt"},
+    {"op": "move", "file": "a.txt", "space": "other"}]}``
+    """
+    upload_folder = os.path.join(BASE_UPLOAD_FOLDER, username)
+    payload = request.get_json(silent=True)
+    actions = payload.get('actions') if isinstance(payload, dict) else None
+    if not isinstance(actions, list) or not actions:
+        log_action(request.remote_addr, f"bulk with no actions for {username}")
+        return jsonify({'error': 'No actions given'}), 400
+
+    os.makedirs(upload_folder, exist_ok=True)
+    # Working copy for lookups; what changed is merged under the lock at the end
+    metadata = load_metadata(upload_folder)
+    # {space: {filename: entry, or None to remove it}}
+    updates = {username: {}}
+    # (space, file, op) recorded once the metadata is saved
+    changed = []
+    now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+    results = []
+
+    try:
+        for action in actions:
+            if not isinstance(action, dict):
+                results.append({'ok': False, 'error': 'Invalid action'})
+                continue
+            op = action.get('op')
+            filename = action.get('file')
+            result = {'op': op, 'file': filename, 'ok': False}
+            results.append(result)
+            if not is_safe_name(filename):
+                result['error'] = 'Invalid filename'
+                continue
+            file_path = os.path.join(upload_folder, filename)
+
+            try:
+                storage = find_storage(storage_key(username, filename))
+
+                if op == 'delete':
+                    if storage is None:
+                        result['error'] = 'File not found'
+                        continue
+                    archive_file(upload_folder, filename)
+                    metadata.pop(filename, None)
+                    updates[username][filename] = None
+                    changed.append((username, filename, 'delete'))
+
+                elif op == 'restore':
+                    version = action.get('version')
+                    staged_path = stage_version(upload_folder, filename, version) if is_safe_name(version) else None
+                    if staged_path is None:
+                        result['error'] = 'Version not found'
+                        continue
+                    archive_file(upload_folder, filename)
+                    os.replace(staged_path, file_path)
+                    metadata[filename] = updates[username][filename] = {'upload_time': now, 'upload_ip': request.remote_addr}
+                    changed.append((username, filename, 'put'))
+
+                elif op == 'rename':
+                    new_name = action.get('to')
+                    if not is_safe_name(new_name):
+                        result['error'] = 'Invalid target name'
+                        continue
+                    if storage is None:
+                        result['error'] = 'File not found'
+                        continue
+                    if new_name == filename:
+                        result['ok'] = True
+                        continue
+                    archive_file(upload_folder, new_name)
+                    storage.move(storage_key(username, filename), storage_key(username, new_name))
+                    metadata[new_name] = updates[username][new_name] = metadata.pop(
+                        filename, {'upload_time': now, 'upload_ip': request.remote_addr})
+                    updates[username][filename] = None
+                    changed += [(username, filename, 'delete'), (username, new_name, 'put')]
+
+                elif op == 'move':
+                    space = action.get('space')
+                    if not is_safe_name(space) or space == username:
+                        result['error'] = 'Invalid target space'
+                        continue
+                    if hash_ring is not None and hash_ring.node_for(space) != NODE_URL:
+                        result['error'] = 'Target space is on another node'
+                        continue
+                    if storage is None:
+                        result['error'] = 'File not found'
+                        continue
+                    target_folder = os.path.join(BASE_UPLOAD_FOLDER, space)
+                    os.makedirs(target_folder, exist_ok=True)
+                    archive_file(target_folder, filename)
+                    storage.move(storage_key(username, filename), storage_key(space, filename))
+                    updates.setdefault(space, {})[filename] = metadata.pop(
+                        filename, {'upload_time': now, 'upload_ip': request.remote_addr})
+                    updates[username][filename] = None
+                    changed += [(username, filename, 'delete'), (space, filename, 'put')]
+                    # Carry the version history along with the file
+                    move_versions(username, space, filename)
+
+                else:
+                    result['error'] = 'Unknown operation'
+                    continue
+            except Exception as e:
+                # Report the failure and keep the bookkeeping of the actions already done
+                logging.exception(f"bulk {op} of {filename} for {username} failed")
+                result['error'] = f'{type(e).__name__}: {e}'
+                continue
+            result['ok'] = True
+    finally:
+        for space, space_updates in updates.items():
+            if space_updates:
+                merge_metadata(space, space_updates)
+        for space, filename, op in changed:
+            change_log.record(space, filename, op)
+    done = sum(1 for r in results if r['ok'])
+    log_action(request.remote_addr, f"bulk {done}/{len(results)} actions {[(r.get('op'), r.get('file')) for r in results]} for {username}")
+    return jsonify({'results': results})
+
 @app.route('/<username>/comment', methods=['POST'])
 def add_comment(username):
     upload_folder = os.path.join(BASE_UPLOAD_FOLDER, username)
@@ -909,12 +2141,254 @@ def delete_space(space):
     """Remove an entire space and its files."""
     upload_folder = os.path.join(BASE_UPLOAD_FOLDER, space)
     if os.path.isdir(upload_folder):
+        for filename in load_metadata(upload_folder):
+            change_log.record(space, filename, 'delete')
         shutil.rmtree(upload_folder)
+        if object_storage is not None:
+            object_storage.delete_prefix(space + '/')
         log_action(request.remote_addr, f"deleted space {space}")
         return '<script>window.location.href = "/?message=Space deleted successfully!";</script>'
     else:
         log_action(request.remote_addr, f"attempted delete of missing space {space}")
         return '<script>window.location.href = "/?message=Space not found!";</script>'
 
+@app.route('/admin/throttle')
+def throttle_stats():
+    """Show bytes, requests and time spent waiting per IP and per space."""
+    return jsonify(shaper.stats())
+
+@app.route('/admin/activity')
+def activity():
+    """Aggregate logged actions over a time range from the hourly rollups."""
+    activity_index.update(blocking=False)
+    now = datetime.datetime.now()
+    # Inputs are 'YYYY-MM-DDTHH:MM' from datetime-local fields; rollups are hourly
+    start = (request.args.get('start') or (now - datetime.timedelta(days=7)).strftime('%Y-%m-%d %H')).replace('T', ' ')[:13]
+    end = (request.args.get('end') or (now + datetime.timedelta(hours=1)).strftime('%Y-%m-%d %H')).replace('T', ' ')[:13]
+    group_by = [c for c in request.args.getlist('group') if c in GROUP_COLUMNS] or ['ip']
+    filters = {c: request.args.get(c, '') for c in ('ip', 'space', 'action')}
+    order = request.args.get('order', 'count')
+    limit = max(1, min(request.args.get('limit', 100, type=int), 10000))
+    rows = activity_index.query(start, end, group_by, filters, order, limit)
+    if request.args.get('format') == 'json':
+        return jsonify(rows)
+    return render_page('''
+    <!doctype html>
+    <html>
+    <head>
+      <meta charset="utf-8">
+      <title>Activity</title>
+      <style>
+        body {
+          font-family: Arial, sans-serif;
+          background-color: #f0f2f5;
+          color: #333;
+          padding: 20px;
+          margin: 0;
+        }
+        h1 {
+          color: #007bff;
+        }
+        table {
+          width: 100%;
+          border-collapse: collapse;
+          margin-bottom: 20px;
+          box-shadow: 0 4px 8px rgba(0, 0, 0, 0.1);
+        }
+        table, th, td { border: 1px solid #ddd; }
+        th, td {
+          padding: 12px;
+          text-align: left;
+        }
+        th {
+          background-color: #007bff;
+          color: white;
+        }
+        input[type="submit"] {
+          background-color: #007bff;
+          color: white;
+          border: none;
+          padding: 10px 15px;
+          margin: 5px 0;
+          cursor: pointer;
+          border-radius: 5px;
+        }
+      </style>
+    </head>
+    <body>
+      <h1>Activity</h1>
+      <form method="get">
+        From <input type="datetime-local" name="start" value="{{ start.replace(' ', 'T') }}:00">
+        to <input type="datetime-local" name="end" value="{{ end.replace(' ', 'T') }}:00">
+        <br>Group by
+        {% for column in columns %}
+          <label><input type="checkbox" name="group" value="{{ column }}" {% if column in group_by %}checked{% endif %}>{{ column }}</label>
+        {% endfor %}
+        <br>IP <input name="ip" value="{{ filters['ip'] }}">
+        Space <input name="space" value="{{ filters['space'] }}">
+        Action <input name="action" value="{{ filters['action'] }}">
+        Order by <select name="order">
+          <option value="count" {% if order != 'bytes' %}selected{% endif %}>count</option>
+          <option value="bytes" {% if order == 'bytes' %}selected{% endif %}>bytes</option>
+        </select>
+        <input type="submit" value="Query">
+      </form>
+      <table>
+        <tr>{% for column in group_by %}<th>{{ column }}</th>{% endfor %}<th>Count</th><th>Bytes</th></tr>
+        {% for row in rows %}
+          <tr>{% for column in group_by %}<td>{{ row[column] }}</td>{% endfor %}<td>{{ row['count'] }}</td><td>{{ row['bytes'] }}</td></tr>
+        {% else %}
+          <tr><td colspan="{{ group_by|length + 2 }}">No activity in this range.</td></tr>
+        {% endfor %}
+      </table>
+    </body>
+    </html>
+    ''', rows=rows, start=start, end=end, group_by=group_by, filters=filters, order=order,
+       columns=list(GROUP_COLUMNS))
+
+@app.route('/admin/profiles')
+def list_profiles():
+    """List saved request captures with their phase timings."""
+    captures = profiler.list()
+    if request.args.get('format') == 'json':
+        return jsonify(captures)
+    return render_page('''
+    <!doctype html>
+    <html>
+    <head>
+      <meta charset="utf-8">
+      <title>Request Profiles</title>
+      <style>
+        body {
+          font-family: Arial, sans-serif;
+          background-color: #f0f2f5;
+          color: #333;
+          padding: 20px;
+          margin: 0;
+        }
+        h1 {
+          color: #007bff;
+        }
+        table {
+          width: 100%;
+          border-collapse: collapse;
+          margin-bottom: 20px;
+          box-shadow: 0 4px 8px rgba(0, 0, 0, 0.1);
+        }
+        table, th, td { border: 1px solid #ddd; }
+        th, td {
+          padding: 12px;
+          text-align: left;
+        }
+        th {
+          background-color: #007bff;
+          color: white;
+        }
+        a { color: #007bff; text-decoration: none; }
+        a:hover { text-decoration: underline; }
+      </style>
+    </head>
+    <body>
+      <h1>Request Profiles</h1>
+      <table>
+        <tr><th>Time</th><th>Request</th><th>Status</th><th>Trigger</th><th>Duration (ms)</th><th>Phases (ms)</th><th>Download</th></tr>
+        {% for c in captures %}
+          <tr>
+            <td>{{ c['time'] }}</td>
+            <td>{{ c['method'] }} {{ c['path'] }}</td>
+            <td>{{ c['status'] }}</td>
+            <td>{{ c['trigger'] }}</td>
+            <td>{{ c['duration_ms'] }}</td>
+            <td>{% for name, ms in c['phases_ms'].items() %}{{ name }}: {{ ms }}<br>{% endfor %}</td>
+            <td>
+              <a href="{{ url_for('download_profile', name=c['name']) }}">JSON</a>
+              {% if c['has_prof'] %} - <a href="{{ url_for('download_profile', name=c['name'], prof=1) }}">.prof</a>{% endif %}
+            </td>
+          </tr>
+        {% else %}
+          <tr><td colspan="7">No captures yet.</td></tr>
+        {% endfor %}
+      </table>
+    </body>
+    </html>
+    ''', captures=captures)
+
+@app.route('/admin/profiles/<name>')
+def download_profile(name):
+    ext = '.prof' if request.args.get('prof') else '.json'
+    return send_from_directory(os.path.abspath(PROFILE_FOLDER), name + ext, as_attachment=True)
+
+@app.route('/cluster/spaces')
+def cluster_spaces():
+    """List the spaces stored on this node."""
+    return jsonify(local_spaces())
+
+@app.route('/cluster/receive/<space>', methods=['POST'])
+def cluster_receive(space):
+    """Accept a space pushed by another member as a tar stream and merge it in."""
+    if not check_cluster_secret():
+        return 'Forbidden', 403
+    if not is_safe_name(space):
+        return 'Invalid space', 400
+    meta_folder = os.path.join(BASE_UPLOAD_FOLDER, space, META_FOLDER_NAME)
+    os.makedirs(meta_folder, exist_ok=True)
+    # Unpacked aside, so the live metadata is only ever changed under its lock
+    staging = tempfile.mkdtemp(prefix='.receive_', dir=meta_folder)
+    try:
+        unpack_space(request.stream, staging)
+        incoming_metadata = load_metadata(staging)
+        imported, versions, _ = merge_staged_space(space, staging, request.remote_addr, keep_all_metadata=True)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    count = len(imported) + versions
+    # Sequences are per node: start a new epoch so mirrors re-read the manifest
+    change_log.reset(space)
+    for filename in incoming_metadata:
+        change_log.record(space, filename)
+    log_action(request.remote_addr, f"received space {space} with {count} files")
+    return jsonify({'space': space, 'files': count})
+
+@app.route('/cluster/rebalance', methods=['POST'])
+def cluster_rebalance():
+    """Push every local space this node no longer owns to its owner."""
+    if not check_cluster_secret():
+        return 'Forbidden', 403
+    if hash_ring is None:
+        return jsonify({'error': 'Cluster mode is not enabled'}), 400
+    moved, failed = [], {}
+    for space in local_spaces():
+        owner = hash_ring.node_for(space)
+        if owner == NODE_URL:
+            continue
+        upload_folder = os.path.join(BASE_UPLOAD_FOLDER, space)
+        with tempfile.TemporaryFile() as tmp:
+            pack_space(upload_folder, tmp)
+            size = tmp.tell()
+            tmp.seek(0)
+            headers = {'Content-Type': 'application/x-tar', 'Content-Length': str(size), FORWARD_HEADER: '1'}
+            if CLUSTER_SECRET:
+                headers[SECRET_HEADER] = CLUSTER_SECRET
+            conn = open_node_connection(owner)
+            try:
+                conn.request('POST', '/cluster/receive/' + urllib.parse.quote(space), body=tmp, headers=headers)
+                status = conn.getresponse().status
+            except OSError as e:
+                status = str(e)
+            finally:
+                conn.close()
+        if status == 200:
+            # Object tier keys are shared by all members, so only local files move
+            shutil.rmtree(upload_folder)
+            moved.append({'space': space, 'to': owner})
+        else:
+            failed[space] = status
+    log_action(request.remote_addr, f"rebalanced {moved}, failed {failed}")
+    return jsonify({'moved': moved, 'failed': failed})
+
 if __name__ == '__main__':
-    app.run(debug=False, host='0.0.0.0', port=5000)
+    # Set before forking, so the workers never start a job thread of their own
+    job_workers_started = True
+    start_workers(JOB_WORKERS, JOBS_DB, JOB_HANDLERS, JOB_FAILURE_HANDLERS)
+    if object_storage is not None:
+        threading.Thread(target=tiering_loop, daemon=True).start()
+    app.run(debug=False, host='0.0.0.0', port=int(os.environ.get('FTP_PORT', '5000')))
@@ -0,0 +1,144 @@
+"""Durable background jobs in SQLite, processed by worker processes.
+
+A job belongs to a file in a space and has a kind ("hash", "zip_folder",
+...). Handlers are plain functions taking the job dict; raising retries the
+job with exponential backoff until ``max_attempts`` is reached.
+"""
+import json
+import logging
+import multiprocessing
+import sqlite3
+import time
+
+POLL_INTERVAL = 1
+LEASE_SECONDS = 3600
+RETRY_DELAY = 5
+KEEP_FINISHED_SECONDS = 7 * 86400
+
+
+class JobQueue:
+    def __init__(self, db_file):
+        self.db_file = db_file
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'space TEXT, filename TEXT, kind TEXT, payload TEXT, '
+                         'status TEXT, attempts INTEGER DEFAULT 0, max_attempts INTEGER, '
+                         'run_after REAL, locked_until REAL, error TEXT, '
+                         'created REAL, updated REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, run_after)')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_space ON jobs (space)')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def enqueue(self, space, filename, kind, payload=None, max_attempts=3):
+        now = time.time()
+        with self._connect() as conn:
+            cur = conn.execute(
+                'INSERT INTO jobs (space, filename, kind, payload, status, max_attempts, '
+                'run_after, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (space, filename, kind, json.dumps(payload or {}), 'queued', max_attempts, now, now, now))
+            return cur.lastrowid
+
+    def claim(self):
+        """Take the oldest runnable job, including ones whose worker died."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE (status = 'queued' AND run_after <= ?) "
+                "OR (status = 'running' AND locked_until < ?) ORDER BY id LIMIT 1",
+                (now, now)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, "
+                         "locked_until = ?, updated = ? WHERE id = ?",
+                         (now + LEASE_SECONDS, now, row['id']))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        job['attempts'] += 1
+        return job
+
+    def complete(self, job):
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = 'done', error = NULL, updated = ? WHERE id = ?",
+                         (time.time(), job['id']))
+
+    def fail(self, job, error):
+        """Schedule a retry, or mark the job failed. Returns True if it will be retried."""
+        now = time.time()
+        retry = job['attempts'] < job['max_attempts']
+        with self._connect() as conn:
+            if retry:
+                conn.execute("UPDATE jobs SET status = 'queued', error = ?, run_after = ?, updated = ? "
+                             "WHERE id = ?", (error, now + RETRY_DELAY * 2 ** (job['attempts'] - 1), now, job['id']))
+            else:
+                conn.execute("UPDATE jobs SET status = 'failed', error = ?, updated = ? WHERE id = ?",
+                             (error, now, job['id']))
+        return retry
+
+    def status(self, space):
+        """Return {filename: {kind: {...}}} with the latest job of each kind per file."""
+        result = {}
+        with self._connect() as conn:
+            rows = conn.execute('SELECT filename, kind, status, attempts, error FROM jobs '
+                                'WHERE space = ? ORDER BY id', (space,)).fetchall()
+        for row in rows:
+            result.setdefault(row['filename'], {})[row['kind']] = {
+                'status': row['status'], 'attempts': row['attempts'], 'error': row['error']}
+        return result
+
+    def prune(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?",
+                         (time.time() - KEEP_FINISHED_SECONDS,))
+
+
+def run_job(queue, job, handlers, failure_handlers=None):
+    try:
+        handlers[job['kind']](job)
+    except Exception as e:
+        logging.exception(f"job {job['id']} {job['kind']} for {job['space']}/{job['filename']} failed")
+        if not queue.fail(job, f'{type(e).__name__}: {e}') and failure_handlers and job['kind'] in failure_handlers:
+            failure_handlers[job['kind']](job)
+    else:
+        queue.complete(job)
+
+
+def run_pending(queue, handlers, failure_handlers=None):
+    """Run every job that is ready now in this process. Returns how many ran."""
+    count = 0
+    while True:
+        job = queue.claim()
+        if job is None:
+            return count
+        run_job(queue, job, handlers, failure_handlers)
+        count += 1
+
+
+def worker_loop(db_file, handlers, failure_handlers=None):
+    queue = JobQueue(db_file)
+    last_prune = 0
+    while True:
+        if time.time() - last_prune > 3600:
+            queue.prune()
+            last_prune = time.time()
+        if not run_pending(queue, handlers, failure_handlers):
+            time.sleep(POLL_INTERVAL)
+
+
+def start_workers(count, db_file, handlers, failure_handlers=None):
+    workers = []
+    for _ in range(count):
+        p = multiprocessing.Process(target=worker_loop, args=(db_file, handlers, failure_handlers), daemon=True)
+        p.start()
+        workers.append(p)
+    return workers
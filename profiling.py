@@ -0,0 +1,171 @@
+"""Per-request profiling: phase timings, cProfile or stack sampling, slow-request capture.
+
+Captures are written as JSON (plus a ``.prof`` file for cProfile runs) to a
+folder that keeps only the newest ``keep`` captures.
+"""
+import collections
+import contextlib
+import contextvars
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+
+SAMPLE_INTERVAL = 0.005
+
+current_profile = contextvars.ContextVar('current_profile', default=None)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Add the time spent in the block to the current request's ``name`` phase."""
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.phases[name] += time.perf_counter() - start
+
+
+class RequestProfile:
+    def __init__(self, info, trigger, use_cprofile, sample_after):
+        self.info = info
+        self.trigger = trigger
+        self.start = time.perf_counter()
+        self.phases = collections.Counter()
+        self.samples = collections.Counter()
+        self.thread_id = threading.get_ident()
+        self.sample_after = sample_after
+        self.handler_end = None
+        self.profiler = None
+        if use_cprofile:
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # Another profiler is running; fall back to stack sampling
+                self.profiler = None
+                self.sample_after = 0
+
+
+class Profiler:
+    """Decides which requests to profile and stores the interesting ones.
+
+    ``sample_rate`` is the fraction of requests to stack-sample from the start;
+    ``slow_ms`` (0 disables) saves any request slower than that, with stack
+    samples taken once it has run for half the threshold.
+    """
+
+    def __init__(self, folder, keep=50, sample_rate=0.0, slow_ms=0):
+        self.folder = folder
+        self.keep = keep
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self._active = {}
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    def begin(self, info, forced=False):
+        """Start timing the current request. ``forced`` turns on cProfile."""
+        if forced:
+            profile = RequestProfile(info, 'header', True, None)
+        elif self.sample_rate and random.random() < self.sample_rate:
+            profile = RequestProfile(info, 'sampled', False, 0)
+        elif self.slow_ms:
+            profile = RequestProfile(info, 'slow', False, self.slow_ms / 2000)
+        else:
+            return None
+        if profile.sample_after is not None:
+            with self._lock:
+                self._active[profile.thread_id] = profile
+                if self._sampler is None:
+                    self._sampler = threading.Thread(target=self._sample_loop, daemon=True)
+                    self._sampler.start()
+        current_profile.set(profile)
+        return profile
+
+    def finish(self, profile, status):
+        """Stop profiling and save the capture if it was requested or slow."""
+        if profile.profiler is not None:
+            profile.profiler.disable()
+        if profile.handler_end is not None:
+            # Time spent streaming the body after the view returned
+            profile.phases['response'] += time.perf_counter() - profile.handler_end
+        with self._lock:
+            self._active.pop(profile.thread_id, None)
+        current_profile.set(None)
+        elapsed_ms = (time.perf_counter() - profile.start) * 1000
+        if profile.trigger == 'slow' and elapsed_ms < self.slow_ms:
+            return None
+        return self._save(profile, status, elapsed_ms)
+
+    def _sample_loop(self):
+        while True:
+            time.sleep(SAMPLE_INTERVAL)
+            now = time.perf_counter()
+            with self._lock:
+                due = [p for p in self._active.values() if now - p.start >= p.sample_after]
+            if not due:
+                continue
+            frames = sys._current_frames()
+            for profile in due:
+                frame = frames.get(profile.thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+                    frame = frame.f_back
+                if stack:
+                    # Collapsed "outer;...;inner" form, ready for flame graph tools
+                    profile.samples[';'.join(reversed(stack))] += 1
+
+    def _save(self, profile, status, elapsed_ms):
+        os.makedirs(self.folder, exist_ok=True)
+        now = time.time()
+        name = f"{time.strftime('%Y%m%d_%H%M%S', time.localtime(now))}_{int(now * 1000) % 1000:03d}_{profile.thread_id % 100000}"
+        capture = dict(profile.info, status=status, trigger=profile.trigger,
+                       duration_ms=round(elapsed_ms, 2),
+                       phases_ms={k: round(v * 1000, 2) for k, v in profile.phases.items()},
+                       stacks=[{'stack': s, 'samples': n} for s, n in profile.samples.most_common(200)])
+        if profile.profiler is not None:
+            out = io.StringIO()
+            pstats.Stats(profile.profiler, stream=out).sort_stats('cumulative').print_stats(50)
+            capture['cprofile'] = out.getvalue()
+            profile.profiler.dump_stats(os.path.join(self.folder, name + '.prof'))
+        with open(os.path.join(self.folder, name + '.json'), 'w', encoding='utf-8') as f:
+            json.dump(capture, f, ensure_ascii=False, indent=4)
+        self._trim()
+        return name
+
+    def _trim(self):
+        captures = sorted(f[:-5] for f in os.listdir(self.folder) if f.endswith('.json'))
+        for name in captures[:-self.keep] if self.keep else []:
+            for ext in ('.json', '.prof'):
+                path = os.path.join(self.folder, name + ext)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def list(self):
+        """Return saved captures, newest first, without their stacks."""
+        if not os.path.isdir(self.folder):
+            return []
+        captures = []
+        for f in sorted(os.listdir(self.folder), reverse=True):
+            if not f.endswith('.json'):
+                continue
+            with open(os.path.join(self.folder, f), 'r', encoding='utf-8') as fh:
+                capture = json.load(fh)
+            capture.pop('stacks', None)
+            capture.pop('cprofile', None)
+            capture['name'] = f[:-5]
+            capture['has_prof'] = os.path.exists(os.path.join(self.folder, f[:-5] + '.prof'))
+            captures.append(capture)
+        return captures
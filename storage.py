@@ -0,0 +1,158 @@
+"""Storage backends used by ftp.py.
+
+Keys are paths relative to the storage root, e.g. ``space/report.pdf`` or
+``space/.versions/report.pdf/20240101_120000_report.pdf``.
+"""
+import os
+import shutil
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class LocalStorage:
+    """Files kept on local disk under a root folder."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+    def size(self, key):
+        return os.path.getsize(self.path(key))
+
+    def getmtime(self, key):
+        return os.path.getmtime(self.path(key))
+
+    def copy_in(self, local_path, key):
+        """Copy a local file into storage, leaving the original."""
+        dst = self.path(key)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copyfile(local_path, dst)
+
+    def download(self, key, local_path):
+        """Copy a stored file to a local path."""
+        shutil.copyfile(self.path(key), local_path)
+
+    def open(self, key, start=0, end=None):
+        """Yield the bytes of a file from ``start`` to ``end`` inclusive."""
+        with open(self.path(key), 'rb') as f:
+            f.seek(start)
+            remaining = None if end is None else end - start + 1
+            while remaining is None or remaining > 0:
+                chunk = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def move(self, src_key, dst_key):
+        dst = self.path(dst_key)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.move(self.path(src_key), dst)
+
+    def delete(self, key):
+        if os.path.isfile(self.path(key)):
+            os.remove(self.path(key))
+
+    def list(self, prefix):
+        """Return the keys of all files below ``prefix``."""
+        base = self.path(prefix)
+        keys = []
+        for dirpath, _, filenames in os.walk(base):
+            for name in filenames:
+                full = os.path.join(dirpath, name)
+                keys.append(os.path.relpath(full, self.root).replace(os.sep, '/'))
+        return keys
+
+    def delete_prefix(self, prefix):
+        if os.path.isdir(self.path(prefix)):
+            shutil.rmtree(self.path(prefix))
+
+
+class S3Storage:
+    """Files kept in an S3-compatible bucket (AWS, MinIO, ...).
+
+    Transfers above ``chunk_size`` use multipart uploads and parallel
+    ranged GETs through boto3's transfer manager.
+    """
+
+    def __init__(self, bucket, endpoint_url=None, prefix='', chunk_size=CHUNK_SIZE):
+        if boto3 is None:
+            raise RuntimeError('boto3 is required for the S3 storage backend')
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.transfer_config = TransferConfig(multipart_threshold=chunk_size,
+                                              multipart_chunksize=chunk_size)
+
+    def _key(self, key):
+        return self.prefix + key
+
+    def _head(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def exists(self, key):
+        return self._head(key) is not None
+
+    def size(self, key):
+        return self._head(key)['ContentLength']
+
+    def getmtime(self, key):
+        return self._head(key)['LastModified'].timestamp()
+
+    def copy_in(self, local_path, key):
+        """Copy a local file into the bucket, leaving the original."""
+        self.client.upload_file(local_path, self.bucket, self._key(key), Config=self.transfer_config)
+
+    def download(self, key, local_path):
+        """Copy an object to a local path."""
+        self.client.download_file(self.bucket, self._key(key), local_path, Config=self.transfer_config)
+
+    def open(self, key, start=0, end=None):
+        """Yield the bytes of an object from ``start`` to ``end`` inclusive with a ranged GET."""
+        byte_range = f'bytes={start}-' if end is None else f'bytes={start}-{end}'
+        obj = self.client.get_object(Bucket=self.bucket, Key=self._key(key), Range=byte_range)
+        for chunk in obj['Body'].iter_chunks(CHUNK_SIZE):
+            yield chunk
+
+    def move(self, src_key, dst_key):
+        self.client.copy({'Bucket': self.bucket, 'Key': self._key(src_key)},
+                         self.bucket, self._key(dst_key), Config=self.transfer_config)
+        self.delete(src_key)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def list(self, prefix):
+        """Return the keys of all objects below ``prefix``."""
+        keys = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._key(prefix)):
+            for obj in page.get('Contents', []):
+                keys.append(obj['Key'][len(self.prefix):])
+        return keys
+
+    def delete_prefix(self, prefix):
+        keys = self.list(prefix)
+        # DeleteObjects accepts at most 1000 keys per call
+        for i in range(0, len(keys), 1000):
+            batch = [{'Key': self._key(k)} for k in keys[i:i + 1000]]
+            self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': batch})
@@ -0,0 +1,148 @@
+"""Mirror a space into a local folder, downloading only new or changed files.
+
+The first run reads /<space>/manifest; later runs only ask /<space>/changes
+for what happened since the last run. If the space's epoch changed (its
+sequence numbers started over, e.g. after it moved to another node), the
+manifest is read again. Files removed from the space are removed locally
+if this client downloaded them.
+
+Usage: python sync.py http://host:5000/<space>/ <folder> [workers]
+"""
+import concurrent.futures
+import hashlib
+import json
+import os
+import sys
+import urllib.parse
+import urllib.request
+
+STATE_FILE = '.ftp-sync.json'
+PART_SUFFIX = '.ftp-sync-part'
+DEFAULT_WORKERS = 4
+READ_SIZE = 1024 * 1024
+
+
+def get_json(url):
+    with urllib.request.urlopen(url) as resp:
+        return json.load(resp)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def version_of(entry):
+    """What identifies a file's content: its hash, or size and mtime if it has none yet."""
+    return entry.get('sha256') or f"{entry['size']}:{entry['mtime']}"
+
+
+def is_safe_name(name):
+    return (bool(name) and name == os.path.basename(name) and name not in ('.', '..')
+            and name != STATE_FILE and not name.endswith(PART_SUFFIX))
+
+
+def download(base, folder, name, entry):
+    """Fetch one file to a temporary name and move it into place once it is complete."""
+    path = os.path.join(folder, name)
+    part = path + PART_SUFFIX
+    digest = hashlib.sha256()
+    with urllib.request.urlopen(base + 'download/' + urllib.parse.quote(name)) as resp, open(part, 'wb') as f:
+        for chunk in iter(lambda: resp.read(READ_SIZE), b''):
+            digest.update(chunk)
+            f.write(chunk)
+    if entry.get('sha256') and digest.hexdigest() != entry['sha256']:
+        os.remove(part)
+        raise ValueError(f'{name}: checksum mismatch, the file probably changed during download')
+    os.replace(part, path)
+    os.utime(path, (entry['mtime'], entry['mtime']))
+
+
+def sync(space_url, folder, workers=DEFAULT_WORKERS):
+    """Bring ``folder`` up to date with a space. Returns a summary dict."""
+    base = space_url.rstrip('/') + '/'
+    os.makedirs(folder, exist_ok=True)
+    state_path = os.path.join(folder, STATE_FILE)
+    state = {'url': base, 'epoch': None, 'seq': None, 'files': {}}
+    if os.path.exists(state_path):
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('url') != base:
+            sys.exit(f'{folder} mirrors {state.get("url")}, not {base}')
+
+    # Latest put entry or None (deleted) per file
+    wanted = {}
+    epoch = state.get('epoch')
+    seq = state['seq']
+    while seq is not None:
+        page = get_json(f'{base}changes?since={seq}')
+        if page['epoch'] != epoch:
+            # Sequence numbers started over: the changes do not follow ours
+            wanted = {}
+            seq = None
+            break
+        for change in page['changes']:
+            wanted[change['file']] = change if change['op'] == 'put' else None
+        seq = page['seq']
+        if not page['more']:
+            break
+    if seq is None:
+        manifest = get_json(base + 'manifest')
+        wanted = dict(manifest['files'])
+        for name in state['files']:
+            wanted.setdefault(name, None)
+        epoch, seq = manifest['epoch'], manifest['seq']
+
+    to_fetch = {}
+    deleted = 0
+    for name, entry in wanted.items():
+        if not is_safe_name(name):
+            continue
+        path = os.path.join(folder, name)
+        if entry is None:
+            if state['files'].pop(name, None) is not None and os.path.isfile(path):
+                os.remove(path)
+                deleted += 1
+            continue
+        version = version_of(entry)
+        if state['files'].get(name) == version and os.path.isfile(path):
+            continue
+        # A file already there from an earlier copy counts if its hash matches
+        if (entry.get('sha256') and os.path.isfile(path) and os.path.getsize(path) == entry['size']
+                and file_sha256(path) == entry['sha256']):
+            state['files'][name] = version
+            continue
+        to_fetch[name] = entry
+
+    failed = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(download, base, folder, name, entry): name for name, entry in to_fetch.items()}
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                failed[name] = str(e)
+            else:
+                state['files'][name] = version_of(to_fetch[name])
+
+    # On failure keep the old sequence, so the next run asks for those files again
+    if not failed:
+        state['epoch'], state['seq'] = epoch, seq
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, state_path)
+    return {'seq': state['seq'], 'downloaded': len(to_fetch) - len(failed), 'deleted': deleted, 'failed': failed}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4):
+        sys.exit('usage: python sync.py http://host:5000/<space>/ <folder> [workers]')
+    summary = sync(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) == 4 else DEFAULT_WORKERS)
+    print(json.dumps(summary, indent=4, ensure_ascii=False))
+    if summary['failed']:
+        sys.exit(1)
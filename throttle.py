@@ -0,0 +1,244 @@
+"""Token-bucket bandwidth shaping and per-client transfer slots.
+
+Waiting callers are never rejected: bucket reservations are served in the
+order they were made, and transfer slots are handed out first come, first
+served per client.
+
+Buckets and statistics are kept per IP and per space, so idle ones are
+dropped: buckets once they have refilled and sat unused for
+``BUCKET_IDLE_SECONDS``, statistics after ``STATS_IDLE_SECONDS`` or when
+more than ``MAX_STATS_KEYS`` clients are tracked.
+"""
+import collections
+import threading
+import time
+
+BUCKET_IDLE_SECONDS = 600
+STATS_IDLE_SECONDS = 24 * 3600
+MAX_STATS_KEYS = 10000
+PRUNE_INTERVAL = 60
+
+
+class TokenBucket:
+    """Token bucket that lets callers go into debt and wait it off."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        """Take ``amount`` tokens and return how long to wait before using them."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_idle(self, now, idle_seconds):
+        """True if unused for ``idle_seconds`` and full again, so a new bucket would behave the same."""
+        with self.lock:
+            return (now - self.updated >= idle_seconds
+                    and self.tokens + (now - self.updated) * self.rate >= self.capacity)
+
+
+class TransferSlots:
+    """At most ``limit`` concurrent transfers per key, queued in arrival order."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._cond = threading.Condition()
+        self._active = collections.Counter()
+        self._waiters = {}
+
+    def acquire(self, key):
+        with self._cond:
+            waiters = self._waiters.setdefault(key, collections.deque())
+            ticket = object()
+            waiters.append(ticket)
+            self._cond.wait_for(lambda: waiters[0] is ticket and self._active[key] < self.limit)
+            waiters.popleft()
+            if not waiters:
+                del self._waiters[key]
+            self._active[key] += 1
+            self._cond.notify_all()
+
+    def release(self, key):
+        with self._cond:
+            self._active[key] -= 1
+            if self._active[key] <= 0:
+                del self._active[key]
+            self._cond.notify_all()
+
+    def active(self, key):
+        return self._active.get(key, 0)
+
+    def queued(self, key):
+        return len(self._waiters.get(key, ()))
+
+
+class ThrottledReader:
+    """File-like wrapper that charges every read against a throttle callback."""
+
+    def __init__(self, stream, throttle):
+        self._stream = stream
+        self._throttle = throttle
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        if data:
+            self._throttle(len(data))
+        return data
+
+    def readinto(self, b):
+        n = self._stream.readinto(b)
+        if n:
+            self._throttle(n)
+        return n
+
+    def readline(self, size=-1):
+        data = self._stream.readline(size)
+        if data:
+            self._throttle(len(data))
+        return data
+
+    def close(self):
+        if hasattr(self._stream, 'close'):
+            self._stream.close()
+
+
+class TransferBody:
+    """Response body wrapper that charges each chunk and runs a callback on close.
+
+    Servers call ``close`` on the body even for pass-through file responses,
+    so this is the one place a transfer is reliably known to be finished.
+    """
+
+    def __init__(self, iterable, on_chunk=None, on_close=None):
+        self._iterable = iterable
+        self._on_chunk = on_chunk
+        self._on_close = on_close
+        self._closed = False
+
+    def __iter__(self):
+        for chunk in self._iterable:
+            if self._on_chunk is not None:
+                self._on_chunk(len(chunk))
+            yield chunk
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if hasattr(self._iterable, 'close'):
+                self._iterable.close()
+        finally:
+            if self._on_close is not None:
+                self._on_close()
+
+
+class Shaper:
+    """Per-IP, per-space and total rate limits plus per-IP transfer slots.
+
+    A rate of 0 disables that limit.
+    """
+
+    def __init__(self, ip_bytes=0, space_bytes=0, total_bytes=0,
+                 ip_requests=0, space_requests=0, max_transfers=0):
+        self.ip_bytes = ip_bytes
+        self.space_bytes = space_bytes
+        self.total_bytes = total_bytes
+        self.ip_requests = ip_requests
+        self.space_requests = space_requests
+        self.slots = TransferSlots(max_transfers) if max_transfers else None
+        self._buckets = {}
+        self._lock = threading.Lock()
+        # {key: [Counter, last seen]}, least recently seen first
+        self._stats = {'ips': collections.OrderedDict(), 'spaces': collections.OrderedDict()}
+        self._pruned = time.monotonic()
+
+    @property
+    def limits_bytes(self):
+        return bool(self.ip_bytes or self.space_bytes or self.total_bytes)
+
+    def _bucket(self, kind, key, rate):
+        with self._lock:
+            bucket = self._buckets.get((kind, key))
+            if bucket is None:
+                bucket = self._buckets[(kind, key)] = TokenBucket(rate)
+            return bucket
+
+    def _prune(self, now):
+        """Drop idle buckets and statistics. Call with ``self._lock`` held."""
+        if now - self._pruned < PRUNE_INTERVAL:
+            return
+        self._pruned = now
+        for key, bucket in list(self._buckets.items()):
+            if bucket.is_idle(now, BUCKET_IDLE_SECONDS):
+                del self._buckets[key]
+        for table in self._stats.values():
+            while table and next(iter(table.values()))[1] < now - STATS_IDLE_SECONDS:
+                table.popitem(last=False)
+
+    def _wait(self, reservations, ip, space, amount, counter):
+        wait = max([bucket.reserve(amount) for bucket in reservations], default=0)
+        with self._lock:
+            now = time.monotonic()
+            for kind, key in [('ips', ip)] + ([('spaces', space)] if space else []):
+                table = self._stats[kind]
+                entry = table.get(key)
+                if entry is None:
+                    entry = table[key] = [collections.Counter(), now]
+                    if len(table) > MAX_STATS_KEYS:
+                        table.popitem(last=False)
+                else:
+                    entry[1] = now
+                    table.move_to_end(key)
+                stats = entry[0]
+                stats[counter] += amount
+                if wait:
+                    stats['throttled'] += 1
+                    stats['wait_seconds'] += wait
+            self._prune(now)
+        if wait:
+            time.sleep(wait)
+
+    def throttle_request(self, ip, space):
+        buckets = []
+        if self.ip_requests:
+            buckets.append(self._bucket('ip_requests', ip, self.ip_requests))
+        if self.space_requests and space:
+            buckets.append(self._bucket('space_requests', space, self.space_requests))
+        self._wait(buckets, ip, space, 1, 'requests')
+
+    def throttle_bytes(self, ip, space, amount):
+        buckets = []
+        if self.ip_bytes:
+            buckets.append(self._bucket('ip_bytes', ip, self.ip_bytes))
+        if self.space_bytes and space:
+            buckets.append(self._bucket('space_bytes', space, self.space_bytes))
+        if self.total_bytes:
+            buckets.append(self._bucket('total_bytes', None, self.total_bytes))
+        self._wait(buckets, ip, space, amount, 'bytes')
+
+    def acquire_transfer(self, ip):
+        if self.slots is not None:
+            self.slots.acquire(ip)
+
+    def release_transfer(self, ip):
+        if self.slots is not None:
+            self.slots.release(ip)
+
+    def stats(self):
+        with self._lock:
+            ips = {ip: dict(c) for ip, (c, _) in self._stats['ips'].items()}
+            spaces = {space: dict(c) for space, (c, _) in self._stats['spaces'].items()}
+        if self.slots is not None:
+            for ip, c in ips.items():
+                c['active_transfers'] = self.slots.active(ip)
+                c['queued_transfers'] = self.slots.queued(ip)
+        return {'ips': ips, 'spaces': spaces}